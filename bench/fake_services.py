@@ -0,0 +1,257 @@
+"""
+Local stand-ins for everything the service talks to, for benchmarks:
+ComfyUI, the Uploadcare CDN, S3 and the backend receiving the webhooks.
+"""
+import asyncio
+import os
+import struct
+import time
+import uuid
+import zlib
+
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
+
+from typing import Dict, List, Optional
+
+def make_png(size: int) -> bytes:
+    """
+    Returns a valid grayscale PNG of roughly `size` bytes.
+    """
+    side = max(int((size * 2) ** 0.5), 8)
+    rows = b''.join(b'\x00' + os.urandom(side) for _ in range(side))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', side, side, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b'')
+
+class FakeComfyUI:
+    """
+    Executes queued prompts one at a time (like ComfyUI on one GPU), sending
+    the usual websocket events and taking `execution_delay` seconds per prompt.
+    """
+
+    def __init__(self, execution_delay: float, steps: int = 20, image_size: int = 512 * 1024) -> None:
+        self.execution_delay = execution_delay
+        self.steps = steps
+        self.image = make_png(image_size)
+        self.pending: List[tuple] = []
+        self.running: List[tuple] = []
+        self.history: Dict[str, dict] = {}
+        # Sizes of the uploaded input images
+        self.uploads: Dict[str, int] = {}
+        self.sockets: Dict[str, WebSocket] = {}
+        self._wakeup = asyncio.Event()
+        self._interrupted = False
+        self.app = self._create_app()
+
+    async def _send(self, client_id: Optional[str], message: dict) -> None:
+        sockets = list(self.sockets.values()) if client_id is None else [self.sockets.get(client_id)]
+        for socket in sockets:
+            if socket is None:
+                continue
+            try:
+                await socket.send_json(message)
+            except Exception:
+                pass
+
+    async def _send_status(self) -> None:
+        remaining = len(self.pending) + len(self.running)
+        await self._send(None, {'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': remaining}}}})
+
+    async def run(self) -> None:
+        while True:
+            while not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            item = self.pending.pop(0)
+            self.running.append(item)
+            prompt_id, client_id, prompt = item
+            await self._send_status()
+            await self._send(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id}})
+
+            for node in prompt:
+                await self._send(client_id, {'type': 'executing', 'data': {'node': node, 'prompt_id': prompt_id}})
+            self._interrupted = False
+            for step in range(1, self.steps + 1):
+                await asyncio.sleep(self.execution_delay / self.steps)
+                if self._interrupted:
+                    break
+                await self._send(client_id, {'type': 'progress',
+                                             'data': {'value': step, 'max': self.steps, 'prompt_id': prompt_id}})
+
+            self.running.remove(item)
+            if self._interrupted:
+                self.history[prompt_id] = {'status': {'status_str': 'error', 'completed': False}, 'outputs': {}}
+                await self._send(client_id, {'type': 'execution_interrupted', 'data': {'prompt_id': prompt_id}})
+            else:
+                filename = f"{prompt_id}.png"
+                self.history[prompt_id] = {
+                    'status': {'status_str': 'success', 'completed': True},
+                    'outputs': {'9': {'images': [{'filename': filename, 'subfolder': '', 'type': 'output'}]}},
+                }
+                await self._send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+            await self._send_status()
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/prompt")
+        async def queue_prompt(request: Request):
+            payload = await request.json()
+            prompt_id = str(uuid.uuid4())
+            self.pending.append((prompt_id, payload.get('client_id'), payload['prompt']))
+            self._wakeup.set()
+            await self._send_status()
+            return {'prompt_id': prompt_id, 'number': len(self.pending), 'node_errors': {}}
+
+        @app.get("/history/{prompt_id}")
+        async def get_history(prompt_id: str):
+            return {prompt_id: self.history[prompt_id]} if prompt_id in self.history else {}
+
+        @app.get("/queue")
+        async def get_queue():
+            return {'queue_running': [[0, p] for p, _, _ in self.running],
+                    'queue_pending': [[0, p] for p, _, _ in self.pending]}
+
+        @app.post("/queue")
+        async def delete_from_queue(request: Request):
+            payload = await request.json()
+            deleted = set(payload.get('delete', []))
+            self.pending = [item for item in self.pending if item[0] not in deleted]
+            await self._send_status()
+            return {}
+
+        @app.post("/interrupt")
+        async def interrupt(request: Request):
+            # Like newer ComfyUI, a prompt_id only interrupts that prompt
+            body = await request.body()
+            prompt_id = (await request.json()).get('prompt_id') if body else None
+            if prompt_id is None or any(item[0] == prompt_id for item in self.running):
+                self._interrupted = True
+            return {}
+
+        @app.post("/upload/image")
+        async def upload_image(request: Request):
+            form = await request.form()
+            image = form['image']
+            self.uploads[image.filename] = len(await image.read())
+            return {'name': image.filename, 'subfolder': form.get('subfolder', ''), 'type': form.get('type', 'input')}
+
+        @app.get("/view")
+        async def view(filename: str, subfolder: str = '', type: str = 'output'):
+            return Response(self.image, media_type='image/png')
+
+        @app.websocket("/ws")
+        async def websocket(socket: WebSocket, clientId: str):
+            await socket.accept()
+            self.sockets[clientId] = socket
+            try:
+                await self._send_status()
+                while True:
+                    await socket.receive_text()
+            except WebSocketDisconnect:
+                pass
+            finally:
+                if self.sockets.get(clientId) is socket:
+                    del self.sockets[clientId]
+
+        return app
+
+def create_file_server(file_size: int) -> FastAPI:
+    """
+    Stand-in for the Uploadcare CDN. Serves `file_size` bytes for any path; .png
+    paths get a real PNG.
+    """
+    app = FastAPI()
+    png = make_png(file_size)
+    blob = os.urandom(file_size)
+
+    @app.get("/{path:path}")
+    async def get_file(path: str):
+        return Response(png if path.endswith('.png') else blob, media_type='application/octet-stream')
+
+    return app
+
+class FakeS3:
+    """
+    Path-style S3 stand-in that accepts single and multipart uploads and only
+    keeps the sizes of the objects.
+    """
+
+    def __init__(self) -> None:
+        self.objects: Dict[str, int] = {}
+        self.uploads: Dict[str, int] = {}
+        self.app = self._create_app()
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.head("/{bucket}")
+        async def head_bucket(bucket: str):
+            # Without it botocore keeps retrying as if the bucket were in another region
+            return Response(headers={'x-amz-bucket-region': 'us-east-1'})
+
+        @app.put("/{bucket}/{key:path}")
+        async def put_object(bucket: str, key: str, request: Request):
+            body = await request.body()
+            upload_id = request.query_params.get('uploadId')
+            if upload_id is not None:
+                self.uploads[upload_id] += len(body)
+            else:
+                self.objects[f"{bucket}/{key}"] = len(body)
+            return Response(headers={'ETag': f'"{uuid.uuid4().hex}"'})
+
+        @app.post("/{bucket}/{key:path}")
+        async def multipart(bucket: str, key: str, request: Request):
+            await request.body()
+            if 'uploads' in request.query_params:
+                upload_id = uuid.uuid4().hex
+                self.uploads[upload_id] = 0
+                body = ('<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                        f'<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                        '</InitiateMultipartUploadResult>')
+                return Response(body, media_type='application/xml')
+
+            upload_id = request.query_params['uploadId']
+            self.objects[f"{bucket}/{key}"] = self.uploads.pop(upload_id, 0)
+            body = ('<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    f'<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{uuid.uuid4().hex}"</ETag>'
+                    '</CompleteMultipartUploadResult>')
+            return Response(body, media_type='application/xml')
+
+        return app
+
+class WebhookSink:
+    """
+    Records the webhooks of the service and wakes up whoever waits for the
+    final webhook of a message.
+    """
+
+    def __init__(self) -> None:
+        self.received: Dict[str, List[dict]] = {}
+        self._finished: Dict[str, asyncio.Future] = {}
+        self.app = self._create_app()
+
+    def expect(self, message_id: str) -> asyncio.Future:
+        return self._finished.setdefault(message_id, asyncio.get_running_loop().create_future())
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/{path:path}")
+        async def receive(path: str, request: Request):
+            payload = await request.json()
+            message_id = str(payload.get('message_id'))
+            payload['received_at'] = time.perf_counter()
+            self.received.setdefault(message_id, []).append(payload)
+
+            if payload.get('status') in ('completed', 'failed', 'cancelled') and payload.get('batch_index') is None:
+                future = self._finished.get(message_id)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+            return {}
+
+        return app
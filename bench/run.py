@@ -0,0 +1,269 @@
+"""
+Load test and benchmark of the service against local stand-ins.
+
+Starts a fake ComfyUI, a fake Uploadcare CDN, an S3 stand-in and a webhook
+sink in this process, runs the service (main:app) as a subprocess pointed at
+them, with the stub FaceFusion worker, and drives its routes at a fixed
+concurrency. A job's latency runs from its submission to its final webhook.
+
+    pip install -r requirements.txt -r bench/requirements.txt
+    python bench/run.py --routes comfyui facefusion --jobs 200 --concurrency 16
+
+The results are printed and saved as JSON (bench/results/ by default) along
+with the configuration and git commit, so runs can be compared across commits.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import uvicorn
+
+import fake_services
+
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest rank
+    index = min(max(math.ceil(q / 100 * len(ordered)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+def summarize(values: List[float]) -> dict:
+    return {'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'mean': sum(values) / len(values) if values else None}
+
+def peak_rss(pid: int) -> Optional[int]:
+    """
+    Returns the peak resident set size of a process in bytes (Linux only).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def child_pids(pid: int) -> List[int]:
+    children = []
+    for name in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The command name may contain spaces, the parent pid comes right after it
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+async def serve(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server
+
+async def wait_ready(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"THE SERVICE EXITED WITH CODE {process.returncode}")
+        try:
+            if (await client.get('/metrics')).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("THE SERVICE DIDN'T START IN TIME")
+
+def comfyui_payload(index: int, message_id: str, user_id: str, files_url: str, args) -> dict:
+    uris = [f"{files_url}/input-{(index + i) % args.distinct_inputs}.png" for i in range(args.inputs)]
+    return {'template_id': 'txt2img',
+            'params': {'seed': index},
+            'uploadcare_uris': uris,
+            'image_ids': [str(uuid.uuid4()) for _ in uris],
+            'image_formats': ['png' for _ in uris],
+            'message_id': message_id,
+            'settings_id': 'bench',
+            'user_id': user_id}
+
+def facefusion_payload(index: int, message_id: str, user_id: str, files_url: str, args) -> dict:
+    return {'source_uris': [f"{files_url}/source-{index % args.distinct_inputs}.png"],
+            'target_uri': f"{files_url}/target-{index % args.distinct_inputs}.mp4",
+            'file_formats': ['png', 'mp4'],
+            'job_id': message_id,
+            'user_id': user_id}
+
+ROUTES = {
+    'comfyui': ('/image-generation/', comfyui_payload),
+    'facefusion': ('/facefusion/', facefusion_payload),
+}
+
+async def drive(route: str, client: httpx.AsyncClient, sink: fake_services.WebhookSink, files_url: str, args) -> dict:
+    path, build_payload = ROUTES[route]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    outcomes = {'completed': 0, 'failed': 0, 'timeout': 0, 'rejected': 0}
+
+    async def one(index: int) -> None:
+        async with semaphore:
+            message_id = str(uuid.uuid4())
+            finished = sink.expect(message_id)
+            payload = build_payload(index, message_id, f"user-{index % args.users}", files_url, args)
+
+            submitted_at = time.perf_counter()
+            while True:
+                response = await client.post(path, json=payload)
+                if response.status_code != 429:
+                    break
+                outcomes['rejected'] += 1
+                await asyncio.sleep(float(response.headers.get('Retry-After', '1')))
+            response.raise_for_status()
+
+            try:
+                webhook = await asyncio.wait_for(finished, args.job_timeout)
+            except asyncio.TimeoutError:
+                outcomes['timeout'] += 1
+                return
+
+            outcomes[webhook['status']] = outcomes.get(webhook['status'], 0) + 1
+            if webhook['status'] == 'completed':
+                latencies.append(webhook['received_at'] - submitted_at)
+                for stage, seconds in (webhook.get('timings') or {}).items():
+                    stages.setdefault(stage, []).append(seconds)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[one(index) for index in range(args.jobs)])
+    wall_seconds = time.perf_counter() - started_at
+
+    return {'jobs': args.jobs,
+            'outcomes': outcomes,
+            'wall_seconds': wall_seconds,
+            'jobs_per_second': outcomes['completed'] / wall_seconds,
+            'latency_seconds': summarize(latencies),
+            'stage_seconds': {stage: summarize(values) for stage, values in sorted(stages.items())}}
+
+async def main(args) -> dict:
+    comfyui = fake_services.FakeComfyUI(args.execution_delay, image_size=args.output_size)
+    s3 = fake_services.FakeS3()
+    sink = fake_services.WebhookSink()
+    ports = {name: free_port() for name in ('comfyui', 'files', 's3', 'webhooks', 'service')}
+
+    await serve(comfyui.app, ports['comfyui'])
+    await serve(fake_services.create_file_server(args.input_size), ports['files'])
+    await serve(s3.app, ports['s3'])
+    await serve(sink.app, ports['webhooks'])
+    asyncio.create_task(comfyui.run())
+
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    webhooks_url = f"http://127.0.0.1:{ports['webhooks']}"
+    env = dict(os.environ,
+               COMFYUI_ADDRESS=f"127.0.0.1:{ports['comfyui']}",
+               COMFYUI_INPUT_DIR=os.path.join(work_dir, 'images') + os.sep,
+               FACEFUSION_FILES_DIR=os.path.join(work_dir, 'files') + os.sep,
+               INPUT_CACHE_DIR=os.path.join(work_dir, 'cache'),
+               COMFYUI_BACKEND_URL=webhooks_url,
+               FACEFUSION_BACKEND_URL=webhooks_url,
+               WEBHOOK_INCLUDE_TIMINGS='1',
+               S3_ENDPOINT_URL=f"http://127.0.0.1:{ports['s3']}",
+               S3_URI=f"http://127.0.0.1:{ports['s3']}/bench",
+               S3_ACCESS_KEY='bench',
+               S3_SECRET_ACCESS_KEY='bench',
+               FACEFUSION_WORKERS=str(args.facefusion_workers),
+               FACEFUSION_WORKER_COMMAND=(f"{sys.executable} {os.path.join(ROOT, 'facefusion_worker.py')} "
+                                          f"--stub --stub-delay {args.facefusion_delay}"),
+               LOG_LEVEL=args.log_level)
+    env.update(dict(setting.split('=', 1) for setting in args.env))
+    for directory in ('images', 'files'):
+        os.makedirs(os.path.join(work_dir, directory))
+
+    log_path = os.path.join(work_dir, 'service.log')
+    with open(log_path, 'w') as service_log:
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app',
+                                    '--host', '127.0.0.1', '--port', str(ports['service'])],
+                                   cwd=ROOT, env=env, stdout=service_log, stderr=subprocess.STDOUT)
+
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{ports['service']}", timeout=60) as client:
+            await wait_ready(client, process)
+
+            results = {}
+            for route in args.routes:
+                print(f"driving {route}: {args.jobs} jobs at concurrency {args.concurrency}", file=sys.stderr)
+                results[route] = await drive(route, client, sink, f"http://127.0.0.1:{ports['files']}", args)
+
+            workers = child_pids(process.pid)
+            return {'commit': git_commit(),
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'config': {key: value for key, value in vars(args).items() if key != 'output'},
+                    'results': results,
+                    'peak_rss_bytes': {'service': peak_rss(process.pid),
+                                       'children': {pid: peak_rss(pid) for pid in workers}},
+                    'service_log': log_path}
+    finally:
+        process.terminate()
+        # The stand-ins run on this loop, so don't block it while the service shuts down against them
+        await asyncio.to_thread(process.wait, 30)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=['comfyui', 'facefusion'])
+    parser.add_argument('--jobs', type=int, default=100, help="jobs per route")
+    parser.add_argument('--concurrency', type=int, default=16, help="jobs in flight at once per route")
+    parser.add_argument('--users', type=int, default=8, help="distinct user ids the jobs are spread over")
+    parser.add_argument('--inputs', type=int, default=1, help="input images per ComfyUI job")
+    parser.add_argument('--distinct-inputs', type=int, default=4, help="distinct input files, for cache reuse")
+    parser.add_argument('--input-size', type=int, default=1024 ** 2, help="bytes per input file")
+    parser.add_argument('--output-size', type=int, default=512 * 1024, help="bytes per ComfyUI output image")
+    parser.add_argument('--execution-delay', type=float, default=0.5, help="seconds ComfyUI spends per prompt")
+    parser.add_argument('--facefusion-delay', type=float, default=1.0, help="seconds FaceFusion spends per job")
+    parser.add_argument('--facefusion-workers', type=int, default=1)
+    parser.add_argument('--job-timeout', type=float, default=600.0)
+    parser.add_argument('--log-level', default='WARNING', help="LOG_LEVEL of the service")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment of the service, e.g. --env COMFYUI_MAX_CONCURRENCY=8")
+    parser.add_argument('--output', help="JSON file for the results, by default in bench/results/")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(main(args))
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         f"{time.strftime('%Y%m%d-%H%M%S')}-{(report['commit'] or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report['results'], indent=2))
+    print(f"saved to {output}", file=sys.stderr)
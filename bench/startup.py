@@ -0,0 +1,183 @@
+"""
+Cold start benchmark of the service.
+
+Measures how long `import main` takes in a fresh interpreter (with the
+slowest modules from `python -X importtime`), checks that heavy modules stay
+out of the import, and times a uvicorn process against the local stand-ins
+from its spawn until it listens and until /ready succeeds.
+
+    pip install -r requirements.txt -r bench/requirements.txt
+    python bench/startup.py --runs 5 --max-import-seconds 2 --max-ready-seconds 10
+
+Exits with status 1 if a limit is exceeded, so it can gate CI. The results are
+printed and saved as JSON (bench/results/ by default) like bench/run.py's.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import fake_services
+import run
+
+from typing import Dict, List, Set, Tuple
+
+# Modules that must only be imported once they are needed
+HEAVY_MODULES = ['boto3', 'botocore', 'cv2', 'numpy']
+
+def service_env(work_dir: str, ports: Dict[str, int], args) -> dict:
+    env = dict(os.environ,
+               COMFYUI_ADDRESS=f"127.0.0.1:{ports['comfyui']}",
+               COMFYUI_INPUT_DIR=os.path.join(work_dir, 'images') + os.sep,
+               FACEFUSION_FILES_DIR=os.path.join(work_dir, 'files') + os.sep,
+               INPUT_CACHE_DIR=os.path.join(work_dir, 'cache'),
+               S3_ENDPOINT_URL=f"http://127.0.0.1:{ports['s3']}",
+               S3_ACCESS_KEY='bench',
+               S3_SECRET_ACCESS_KEY='bench',
+               FACEFUSION_WORKER_COMMAND=(f"{sys.executable} {os.path.join(run.ROOT, 'facefusion_worker.py')} "
+                                          f"--stub --stub-delay 0"),
+               LOG_LEVEL='WARNING')
+    env.update(dict(setting.split('=', 1) for setting in args.env))
+    return env
+
+def measure_import(env: dict) -> Tuple[float, List[Tuple[str, float]], Set[str]]:
+    """
+    Imports main in a fresh interpreter.
+
+    Returns:
+        Tuple[float, List[Tuple[str, float]], Set[str]]: Seconds the import
+        took, the cumulative seconds of every top-level module it imported, and
+        the names of all the modules it imported.
+    """
+    started_at = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=run.ROOT, env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - started_at
+    if result.returncode != 0:
+        raise RuntimeError(f"IMPORTING MAIN FAILED:\n{result.stderr[-2000:]}")
+
+    modules = []
+    names = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        names.add(name.strip())
+        # Nested imports are indented under their parent
+        if not name.startswith('  '):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return seconds, modules, names
+
+async def measure_startup(env: dict, port: int, timeout: float) -> Dict[str, float]:
+    """
+    Starts the service and returns the seconds until it listened and until
+    /ready succeeded.
+    """
+    timings = {}
+    started_at = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port)],
+                               cwd=run.ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            deadline = started_at + timeout
+            while time.perf_counter() < deadline:
+                if process.poll() is not None:
+                    raise RuntimeError(f"THE SERVICE EXITED WITH CODE {process.returncode}")
+                try:
+                    response = await client.get('/ready')
+                    timings.setdefault('listening_seconds', time.perf_counter() - started_at)
+                    if response.status_code == 200:
+                        timings['ready_seconds'] = time.perf_counter() - started_at
+                        return timings
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.05)
+        raise RuntimeError("THE SERVICE WASN'T READY IN TIME")
+    finally:
+        process.terminate()
+        # The stand-ins run on this loop, so don't block it while the service shuts down against them
+        await asyncio.to_thread(process.wait, 30)
+
+async def main(args) -> dict:
+    comfyui = fake_services.FakeComfyUI(0.1)
+    s3 = fake_services.FakeS3()
+    ports = {name: run.free_port() for name in ('comfyui', 's3')}
+    await run.serve(comfyui.app, ports['comfyui'])
+    await run.serve(s3.app, ports['s3'])
+    asyncio.create_task(comfyui.run())
+
+    work_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    for directory in ('images', 'files'):
+        os.makedirs(os.path.join(work_dir, directory))
+    env = service_env(work_dir, ports, args)
+
+    import_seconds = []
+    modules: Dict[str, List[float]] = {}
+    names = set()
+    for _ in range(args.runs):
+        seconds, imported, imported_names = await asyncio.to_thread(measure_import, env)
+        import_seconds.append(seconds)
+        names |= imported_names
+        for name, cumulative in imported:
+            modules.setdefault(name, []).append(cumulative)
+
+    startups = []
+    for _ in range(args.runs):
+        startups.append(await measure_startup(env, run.free_port(), args.ready_timeout))
+
+    slowest = sorted(((statistics.median(values), name) for name, values in modules.items()), reverse=True)
+    return {'commit': run.git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+            'import_seconds': run.summarize(import_seconds),
+            'slowest_imports': [{'module': name, 'seconds': seconds} for seconds, name in slowest[:args.top]],
+            'heavy_modules_imported': [name for name in HEAVY_MODULES if name in names],
+            'listening_seconds': run.summarize([startup['listening_seconds'] for startup in startups]),
+            'ready_seconds': run.summarize([startup['ready_seconds'] for startup in startups])}
+
+def check(report: dict, args) -> List[str]:
+    failures = []
+    if report['heavy_modules_imported']:
+        failures.append(f"HEAVY MODULES IMPORTED BY main: {report['heavy_modules_imported']}")
+    if args.max_import_seconds and report['import_seconds']['p50'] > args.max_import_seconds:
+        failures.append(f"MEDIAN IMPORT TIME {report['import_seconds']['p50']:.3f}S EXCEEDS {args.max_import_seconds}S")
+    if args.max_ready_seconds and report['ready_seconds']['p50'] > args.max_ready_seconds:
+        failures.append(f"MEDIAN TIME TO READY {report['ready_seconds']['p50']:.3f}S EXCEEDS {args.max_ready_seconds}S")
+    return failures
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help="slowest top-level imports to report")
+    parser.add_argument('--ready-timeout', type=float, default=120.0)
+    parser.add_argument('--max-import-seconds', type=float, help="fail if the median import of main is slower")
+    parser.add_argument('--max-ready-seconds', type=float, help="fail if the median time to /ready is longer")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment of the service, e.g. --env READY_CHECKS=comfyui")
+    parser.add_argument('--output', help="JSON file for the results, by default in bench/results/")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(main(args))
+
+    output = args.output or os.path.join(run.ROOT, 'bench', 'results',
+                                         f"startup-{time.strftime('%Y%m%d-%H%M%S')}-{(report['commit'] or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+    print(f"saved to {output}", file=sys.stderr)
+
+    failures = check(report, args)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -1,134 +1,504 @@
-import websocket
+import asyncio
 import uuid
 import json
 import os
-import urllib.request
-import urllib.parse
+import time
 
+import comfyui_pool
 import comfyui_utils
+import input_cache
+import job_routes
+import jobs
+import log
+import metrics
+import preprocessing
+import progress
+import result_cache
+import workflow_templates
 
-from fastapi import Request, APIRouter
+from fastapi import Request, APIRouter, HTTPException
 
 router = APIRouter(prefix="/image-generation")
 
+logger = log.get_logger(__name__)
+
 client_id = str(uuid.uuid4())
-server_address = "127.0.0.1:8188"
-
-def queue_prompt(prompt):
-    print("QUEUEING PROMPT")
-    p = {"prompt": prompt, "client_id": client_id}
-    print(f"GOT THE PRMOPT {prompt}")
-    data = json.dumps(p).encode('utf-8')
-    req =  urllib.request.Request("http://{}/prompt".format(server_address), data=data)
-    print(f"SENT A REQUEST TO COMFY: {req}")
-    return json.loads(urllib.request.urlopen(req).read())
-
-def get_image(filename, subfolder, folder_type):
-    print(f"GETTING IMAGE --filename: {filename} --subfolder: {subfolder} --folder_type: {folder_type}")
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    print(f"URL VALUES: {url_values}")
-    with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
-        print("READING RESPONSE")
-        return response.read()
-
-def get_history(prompt_id):
-    with urllib.request.urlopen(f"http://{server_address}/history/{prompt_id}") as response:
-        # Read response content
-        response_content = response.read()
-        print(f"GOT HISTORY FOR PROMPT ID {prompt_id}: {response_content}")
-        # Decode the JSON content
-        return json.loads(response_content)
-
-def get_images(ws, prompt):
-    print("QUEUEING PROMPT")
-    prompt_id = queue_prompt(prompt)['prompt_id']
-    raw_images_output = []
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            print("IS AN INSTANCE - GETTING THE OUTPUT")
-            message = json.loads(out)
-            print(f"OUTPUT MESSAGE: {message}")
-            if message['type'] == 'executing':
-                print("MESSAGE TYPE IS EXECUTING")
-                data = message['data']
-                print(f"GOT MESSAGE DATA {data}")
-                if data['node'] is None and data['prompt_id'] == prompt_id:
-                    print("EXECUTION IS DONE")
-                    break #Execution is done
+# Comma separated host:port of every ComfyUI instance, e.g. one per GPU
+server_addresses = os.getenv('COMFYUI_ADDRESSES', os.getenv('COMFYUI_ADDRESS', "127.0.0.1:8188")).split(',')
+
+WS_CONNECT_TIMEOUT = float(os.getenv('COMFYUI_WS_CONNECT_TIMEOUT', '30'))
+HISTORY_POLL_SECONDS = float(os.getenv('COMFYUI_HISTORY_POLL_SECONDS', '30'))
+# 'filesystem' saves the job's images to ComfyUI's input directory, 'upload'
+# sends them from memory through the /upload/image API of the chosen backend
+INPUT_MODE = os.getenv('COMFYUI_INPUT_MODE', 'filesystem')
+# ComfyUI's input directory, where LoadImage nodes read the job's images from
+INPUT_DIR = os.getenv('COMFYUI_INPUT_DIR', '/workspace/images/')
+# Subfolder of ComfyUI's input directory for uploaded images
+UPLOAD_SUBFOLDER = os.getenv('COMFYUI_UPLOAD_SUBFOLDER', 'api')
+MAX_BATCH_SIZE = int(os.getenv('COMFYUI_MAX_BATCH_SIZE', '64'))
+# Jobs wait to start while ComfyUI has this many prompts running or pending, 0 disables the check
+MAX_QUEUE_DEPTH = int(os.getenv('COMFYUI_MAX_QUEUE_DEPTH', '8'))
+
+pool = comfyui_pool.ComfyUIPool([address.strip() for address in server_addresses if address.strip()],
+                                client_id,
+                                http_timeout=float(os.getenv('COMFYUI_HTTP_TIMEOUT', '30')),
+                                http_max_connections=int(os.getenv('COMFYUI_HTTP_MAX_CONNECTIONS', '32')),
+                                health_interval=float(os.getenv('COMFYUI_HEALTH_INTERVAL', '10')),
+                                max_failures=int(os.getenv('COMFYUI_MAX_FAILURES', '3')))
+metrics.COMFYUI_QUEUE_DEPTH.set_function(pool.loads)
+metrics.COMFYUI_BACKEND_UP.set_function(pool.health)
+
+jobs.engine.scheduler['comfyui'].set_depth_probe(pool.min_queue_depth, MAX_QUEUE_DEPTH)
+
+class JobInputs:
+    """
+    The input images of a job, staged according to INPUT_MODE: saved to the
+    shared input directory up front, or fetched into memory and uploaded to
+    every backend a prompt of the job is queued on, with the workflow's
+    LoadImage nodes patched to the uploaded names.
+
+    Images larger than `max_side` are downscaled first, see preprocessing.
+    """
+
+    def __init__(self, uploadcare_uris: list, image_ids: list, image_formats: list, max_side: int = 0) -> None:
+        self.uploadcare_uris = uploadcare_uris
+        self.image_ids = image_ids
+        self.image_formats = image_formats
+        self.max_side = max_side
+        # Input cache entries pinned by the job, in filesystem mode
+        self.digests = []
+        # Digests of the images as handed over, in filesystem mode
+        self.saved = []
+        # (file name, content, SHA-256) of every image, in upload mode
+        self.images = []
+        # ComfyUI's names for the images, by backend address
+        self.uploaded = {}
+
+    async def fetch(self) -> None:
+        if INPUT_MODE == 'upload':
+            images = await comfyui_utils.fetch_images(self.uploadcare_uris, self.image_ids, self.image_formats)
+            processed = await asyncio.gather(*[preprocessing.preprocessor.process(data, digest, self.max_side)
+                                               for _, data, digest in images])
+            self.images = [(name, data, digest) for (name, _, _), (data, digest) in zip(images, processed)]
         else:
-            print("IS NOT AN INSTANCE - CONTINUING POLLING")
-            continue #previews are binary data
-    
+            self.digests = await comfyui_utils.download_and_save_images(self.uploadcare_uris, self.image_ids, self.image_formats, INPUT_DIR)
+            self.saved = list(self.digests)
+            if self.max_side > 0:
+                self.saved = await asyncio.gather(*[self._preprocess_file(name, digest)
+                                                    for name, digest in zip(self._names(), self.digests)])
+
+    def _names(self) -> list:
+        return [f"{image_id}.{image_format}" for image_id, image_format in zip(self.image_ids, self.image_formats) if image_id]
+
+    async def _preprocess_file(self, name: str, digest) -> str:
+        path = os.path.join(INPUT_DIR, name)
+        if digest is None:
+            # The input cache is disabled
+            digest = await jobs.engine.run_blocking(input_cache.hash_file, path)
+        return await preprocessing.preprocessor.process_file(path, digest, self.max_side)
+
+    def hashes(self) -> list:
+        """
+        Returns (file name, path, SHA-256) of every image, for the result cache.
+        """
+        if INPUT_MODE == 'upload':
+            return [(name, None, digest) for name, _, digest in self.images]
+
+        return [(name, os.path.join(INPUT_DIR, name), digest) for name, digest in zip(self._names(), self.saved)]
+
+    async def prepare(self, backend, prompt: dict) -> dict:
+        if not self.images:
+            return prompt
+
+        if backend.address not in self.uploaded:
+            self.uploaded[backend.address] = await comfyui_utils.upload_images_to_comfyui(backend.http, self.images, UPLOAD_SUBFOLDER)
+        return comfyui_utils.patch_image_inputs(prompt, self.uploaded[backend.address])
+
+    async def cleanup(self) -> None:
+        if INPUT_MODE == 'upload':
+            # ComfyUI has no API to delete inputs; the content-addressed names
+            # keep repeated images from piling up there
+            self.images = []
+            return
+
+        await jobs.engine.run_blocking(comfyui_utils.remove_images, self.image_ids, self.image_formats, INPUT_DIR)
+        input_cache.cache.release(self.digests)
+
+async def queue_prompt(prompt, inputs=None):
+    """
+    Queues a prompt on the least loaded ComfyUI backend, staging the job's
+    inputs there first if needed. The backend must be released once the
+    prompt's outputs are collected.
+
+    Returns:
+        Tuple[ComfyUIBackend, str]: The backend and the prompt id.
+    """
+    logger.debug("QUEUEING PROMPT %s", log.truncate(prompt))
+    backend, response = await pool.queue_prompt(prompt, WS_CONNECT_TIMEOUT, inputs.prepare if inputs is not None else None)
+    logger.info("QUEUED PROMPT %s ON %s", response['prompt_id'], backend.address)
+    return backend, response['prompt_id']
+
+async def cancel_prompt(backend, prompt_id):
     try:
-        print("GETTING THE HISTORY FOR THE REQUESTED PROMPT")
-        history = get_history(prompt_id)[prompt_id]
-
-        status = history['status']['status_str']
-        print(f"GENERATION STATUS: {status}")
-
-        completed = history['status']['completed']
-        print(f"GENERATION COMPLETED: {completed}")
-
-        if status == "success" and completed:
-            for o in history['outputs']:
-                print(f"GOT OUTPUT: {o}")
-                node_output = history['outputs'][o]
-                print(f"NODE OUTPUT {node_output}")
-                if 'images' in node_output:
-                    print("IMAGES FOUND IN NODE OUTPUT")
-                    for image in node_output['images']:
-                        print(f"GOT AN IMAGE {image}")
-                        image_data = get_image(image['filename'], image['subfolder'], image['type'])
-
-                        raw_images_output.append(image_data)
-                else:
-                    print("IMAGES NOT FOUND IN NODE OUTPUT")
-
-            return raw_images_output
-        else:
-            print(f"COULDN'T GENERATE IMAGES FOR PROMPT ID: {prompt_id}")
-    except json.JSONDecodeError as e:
-        print(f"JSON DECODE ERROR: {e}")
+        await backend.http.cancel_prompt(prompt_id)
+        logger.info("CANCELLED PROMPT %s ON %s", prompt_id, backend.address)
     except Exception as e:
-        print(f"WHILE READING EXECUTION HISTORY EXCEPTION OCCURED: {e}")
+        logger.warning("COULDN'T CANCEL PROMPT %s ON %s: %s", prompt_id, backend.address, e)
 
+async def get_history(backend, prompt_id):
+    return await backend.http.get_history(prompt_id)
 
-@router.post("/")
-async def create_item(request: Request):
-    payload = await request.json() 
-    workflow = payload.get('workflow', {})
-    uploadcare_uris = payload.get('uploadcare_uris', {})
-    image_ids = payload.get('image_ids', {})
-    image_formats = payload.get('image_formats', {})
-    message_id = payload.get('message_id', {})
-    settings_id = payload.get('settings_id', {})
-    user_id = payload.get('user_id', {})
+async def wait_for_prompt(backend, prompt_id, tracker=None):
+    """
+    Waits until ComfyUI is done with a prompt, forwarding node and step
+    progress to the job's progress tracker.
+
+    Returns:
+        Optional[float]: perf_counter() time at which execution started, if it was seen.
+    """
+    started_at = None
+    events = backend.events
+    queue = events.watch(prompt_id)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), HISTORY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                message = {'type': events.RECONNECTED, 'data': {}}
+
+            if message['type'] == 'execution_start':
+                started_at = time.perf_counter()
+            elif message['type'] == 'executing' and message['data']['node'] is not None:
+                if tracker is not None:
+                    await tracker.update(node=message['data']['node'])
+            elif message['type'] == 'progress':
+                if tracker is not None:
+                    data = message['data']
+                    await tracker.update(node=data.get('node'), value=data['value'], max=data['max'])
+            elif message['type'] == 'executing' and message['data']['node'] is None:
+                logger.info("EXECUTION IS DONE")
+                return started_at
+            elif message['type'] in ('execution_error', 'execution_interrupted'):
+                logger.warning("EXECUTION STOPPED: %s", log.truncate(message))
+                return started_at
+            elif message['type'] == events.RECONNECTED:
+                # Events may have been missed, so ask the history whether the prompt already finished
+                history = await get_history(backend, prompt_id)
+                if prompt_id in history:
+                    logger.info("EXECUTION IS DONE")
+                    return started_at
+    finally:
+        events.unwatch(prompt_id)
+
+async def get_images(job, prompt, tracker=None, inputs=None):
+    logger.info("QUEUEING PROMPT")
+    queued_at = time.perf_counter()
+    backend, prompt_id = await queue_prompt(prompt, inputs)
+    try:
+        return await collect_images(job, backend, prompt_id, queued_at, tracker)
+    except asyncio.CancelledError:
+        await cancel_prompt(backend, prompt_id)
+        raise
+    finally:
+        pool.release(backend)
+
+async def collect_images(job, backend, prompt_id, queued_at, tracker=None):
+    """
+    Waits for a queued prompt to finish and fetches its output images.
+
+    Returns:
+        Optional[List[bytes]]: The images, or None if the generation failed.
+    """
+    with log.context(prompt_id=prompt_id):
+        started_at = await wait_for_prompt(backend, prompt_id, tracker)
+        finished_at = time.perf_counter()
+        started_at = started_at or queued_at
+        metrics.record(job, 'queue_wait', started_at - queued_at)
+        metrics.record(job, 'execution', finished_at - started_at)
+
+        try:
+            history = (await get_history(backend, prompt_id))[prompt_id]
+            logger.debug("GOT HISTORY %s", log.truncate(history))
+
+            status = history['status']['status_str']
+            completed = history['status']['completed']
+            logger.info("GENERATION STATUS: %s, COMPLETED: %s", status, completed)
+
+            if status == "success" and completed:
+                logger.info("FETCHING THE OUTPUT IMAGES OF NODES: %s", list(history['outputs']))
+                with metrics.timed(job, 'fetch'):
+                    raw_images_output = await backend.http.get_output_images(history['outputs'])
+
+                return raw_images_output
+            else:
+                logger.error("COULDN'T GENERATE IMAGES FOR PROMPT ID: %s", prompt_id)
+        except json.JSONDecodeError as e:
+            logger.error("JSON DECODE ERROR: %s", e)
+        except Exception as e:
+            logger.exception("WHILE READING EXECUTION HISTORY EXCEPTION OCCURED: %s", e)
 
-    webhook_url = f"{os.getenv('COMFYUI_BACKEND_URL')}/image-generation/webhook"
 
-    print(image_formats)
+async def run_generation(job: jobs.Job,
+                         workflow: dict,
+                         uploadcare_uris: list,
+                         image_ids: list,
+                         image_formats: list,
+                         message_id: str,
+                         settings_id: str,
+                         user_id: str,
+                         use_cache: bool = True,
+                         max_input_side: int = 0):
+    log.user_id.set(user_id)
+
+    webhook_url = f"{os.getenv('COMFYUI_BACKEND_URL')}/image-generation/webhook"
 
     await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'in progress', webhook_url)
 
+    inputs = JobInputs(uploadcare_uris, image_ids, image_formats, max_input_side)
+
     try:
-        predefined_path = '/workspace/images/'
+        with metrics.timed(job, 'download'):
+            await inputs.fetch()
+
+        cache_key = None
+        if use_cache and result_cache.cache.enabled:
+            cache_key = await result_cache.cache.key(workflow, inputs.hashes())
 
-        comfyui_utils.download_and_save_images(uploadcare_uris, image_ids, image_formats, predefined_path)
+            s3_uris = await result_cache.cache.get(cache_key)
+            if s3_uris is not None:
+                logger.info("RESULT CACHE HIT, SKIPPING THE GENERATION")
+                await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'completed', webhook_url, s3_uris, timings=job.timings)
+                return s3_uris
+
+        async def notify(event):
+            await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'in progress', webhook_url, progress=event)
+
+        tracker = progress.ProgressTracker(job, notify, progress.WEBHOOK_INTERVAL)
+        images = await get_images(job, workflow, tracker, inputs)
 
-        ws = websocket.WebSocket()
-        ws.connect("ws://{}/ws?clientId={}".format(server_address, client_id))
-        images = get_images(ws, workflow)
-        
         if images:
-            s3_uris = comfyui_utils.upload_images_to_s3(images)
+            with metrics.timed(job, 'upload'):
+                s3_uris = await comfyui_utils.upload_images_to_s3(images)
+
+            if cache_key is not None:
+                await result_cache.cache.put(cache_key, s3_uris)
 
-            await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'completed', webhook_url, s3_uris)
+            await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'completed', webhook_url, s3_uris, timings=job.timings)
+
+            return s3_uris
         else:
             raise Exception("GENERATED NO IMAGES")
+    except asyncio.CancelledError:
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'cancelled', webhook_url)
+        raise
     except Exception as e:
-        print(f"ERROR: {e}")
+        logger.error("ERROR: %s", e)
         await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'failed', webhook_url)
+        raise
+    finally:
+        await inputs.cleanup()
+
+async def run_batch_item(job, index, backend, prompt_id, queued_at, webhook, per_item_webhooks):
+    user_id, message_id, settings_id, webhook_url = webhook
+
+    async def notify(event):
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'in progress', webhook_url,
+                                                        progress=event, batch_index=index)
+
+    tracker = progress.ProgressTracker(job, notify if per_item_webhooks else None, progress.WEBHOOK_INTERVAL, item=index)
+
+    try:
+        images = await collect_images(job, backend, prompt_id, queued_at, tracker)
+        if not images:
+            raise Exception("GENERATED NO IMAGES")
+
+        with metrics.timed(job, 'upload'):
+            s3_uris = await comfyui_utils.upload_images_to_s3(images)
+    except Exception as e:
+        logger.error("BATCH ITEM %s FAILED: %s", index, e)
+        if per_item_webhooks:
+            await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'failed', webhook_url,
+                                                            batch_index=index)
+        return None
+
+    if per_item_webhooks:
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'completed', webhook_url, s3_uris,
+                                                        batch_index=index)
+    return s3_uris
+
+async def run_batch(job: jobs.Job,
+                    workflows: list,
+                    uploadcare_uris: list,
+                    image_ids: list,
+                    image_formats: list,
+                    message_id: str,
+                    settings_id: str,
+                    user_id: str,
+                    per_item_webhooks: bool,
+                    max_input_side: int = 0):
+    """
+    Runs a batch of workflows as one job. Every prompt is queued on ComfyUI up
+    front so the GPU goes straight from one to the next, and the outputs of
+    each prompt are fetched and uploaded as soon as it finishes.
+    """
+    log.user_id.set(user_id)
+
+    webhook_url = f"{os.getenv('COMFYUI_BACKEND_URL')}/image-generation/webhook"
+    webhook = (user_id, message_id, settings_id, webhook_url)
+
+    await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'in progress', webhook_url)
+
+    inputs = JobInputs(uploadcare_uris, image_ids, image_formats, max_input_side)
+    queued = []
+    # Set once every prompt's outputs are collected and nothing is left to cancel
+    collected = False
+
+    try:
+        with metrics.timed(job, 'download'):
+            await inputs.fetch()
+
+        # Every prompt goes to the least loaded backend, so a batch spreads over all of them
+        logger.info("QUEUEING %s PROMPTS", len(workflows))
+        for workflow in workflows:
+            queued_at = time.perf_counter()
+            backend, prompt_id = await queue_prompt(workflow, inputs)
+            queued.append((backend, prompt_id, queued_at))
+
+        results = await asyncio.gather(*[
+            run_batch_item(job, index, backend, prompt_id, queued_at, webhook, per_item_webhooks)
+            for index, (backend, prompt_id, queued_at) in enumerate(queued)
+        ])
+        collected = True
+
+        if all(result is None for result in results):
+            raise Exception("GENERATED NO IMAGES")
+
+        batch_s3_uris = [result or [] for result in results]
+        s3_uris = [uri for uris in batch_s3_uris for uri in uris]
+
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'completed', webhook_url, s3_uris,
+                                                        timings=job.timings, batch_s3_uris=batch_s3_uris)
+
+        return batch_s3_uris
+    except asyncio.CancelledError:
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'cancelled', webhook_url)
+        raise
+    except Exception as e:
+        logger.error("ERROR: %s", e)
+        await comfyui_utils.send_webhook_acknowledgment(user_id, message_id, settings_id, 'failed', webhook_url)
+        raise
+    finally:
+        if not collected:
+            # Don't leave the prompts queued so far running on the GPU for a dead job
+            await asyncio.gather(*[cancel_prompt(backend, prompt_id) for backend, prompt_id, _ in queued])
+        for backend, _, _ in queued:
+            pool.release(backend)
+        await inputs.cleanup()
+
+def resolve_workflow(payload):
+    """
+    Returns the workflow of a request: either the full graph in 'workflow', or
+    the server-side template named by 'template_id' (and optionally
+    'template_version') with 'params' patched in.
+    """
+    if 'template_id' not in payload:
+        return payload.get('workflow', {})
+
+    try:
+        return workflow_templates.registry.render(payload['template_id'],
+                                                  payload.get('template_version'),
+                                                  payload.get('params', {}))
+    except workflow_templates.TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def resolve_workflows(payload):
+    """
+    Returns the workflows of a batch request: either the graphs in
+    'workflows', or one render of the template named by 'template_id' per
+    entry of 'params_list'.
+    """
+    if 'template_id' not in payload:
+        workflows = payload.get('workflows', [])
+    else:
+        try:
+            template = workflow_templates.registry.get(payload['template_id'], payload.get('template_version'))
+            workflows = [template.render(params) for params in payload.get('params_list', [])]
+        except workflow_templates.TemplateError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if not workflows:
+        raise HTTPException(status_code=400, detail="BATCH HAS NO WORKFLOWS")
+    if len(workflows) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"BATCH IS LARGER THAN {MAX_BATCH_SIZE} WORKFLOWS")
+
+    return workflows
+
+def resolve_input_cap(payload):
+    """
+    Returns the resolution cap of a request's input images: 'max_input_side'
+    if given, else the cap of its template, else PREPROCESS_MAX_SIDE.
+    """
+    if payload.get('max_input_side') is not None:
+        try:
+            return preprocessing.preprocessor.cap(payload['max_input_side'])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if 'template_id' in payload:
+        try:
+            template = workflow_templates.registry.get(payload['template_id'], payload.get('template_version'))
+        except workflow_templates.TemplateError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if template.max_input_side is not None:
+            return template.max_input_side
+
+    return preprocessing.preprocessor.cap()
+
+@router.get("/templates")
+async def list_templates():
+    return workflow_templates.registry.describe()
+
+@router.post("/", status_code=202)
+async def create_item(request: Request):
+    payload = await request.json() 
+    workflow = resolve_workflow(payload)
+    uploadcare_uris = payload.get('uploadcare_uris', {})
+    image_ids = payload.get('image_ids', {})
+    image_formats = payload.get('image_formats', {})
+    message_id = payload.get('message_id', {})
+    settings_id = payload.get('settings_id', {})
+    user_id = payload.get('user_id', {})
+    # Workflows with random seeds must not be served from the result cache
+    try:
+        use_cache = workflow_templates.parse_bool(payload.get('cache', True))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"CACHE: {e}")
+    max_input_side = resolve_input_cap(payload)
+
+    # A retried request with the same message id gets the job of the first one
+    job = jobs.engine.submit('comfyui', run_generation, workflow, uploadcare_uris, image_ids, image_formats, message_id, settings_id, user_id, use_cache, max_input_side,
+                             user_id=user_id, priority=payload.get('priority', 'normal'),
+                             idempotency_key=str(message_id) if message_id else None)
+
+    return {'job_id': job.job_id, 'status': job.status, 'result': job.result}
+
+@router.post("/batch", status_code=202)
+async def create_batch(request: Request):
+    payload = await request.json()
+    workflows = resolve_workflows(payload)
+    uploadcare_uris = payload.get('uploadcare_uris', {})
+    image_ids = payload.get('image_ids', {})
+    image_formats = payload.get('image_formats', {})
+    message_id = payload.get('message_id', {})
+    settings_id = payload.get('settings_id', {})
+    user_id = payload.get('user_id', {})
+    per_item_webhooks = payload.get('webhook_mode', 'aggregate') == 'per_item'
+    max_input_side = resolve_input_cap(payload)
+
+    job = jobs.engine.submit('comfyui', run_batch, workflows, uploadcare_uris, image_ids, image_formats, message_id, settings_id, user_id, per_item_webhooks, max_input_side,
+                             user_id=user_id, priority=payload.get('priority', 'normal'),
+                             idempotency_key=f"batch/{message_id}" if message_id else None)
+
+    return {'job_id': job.job_id, 'status': job.status, 'size': len(workflows), 'result': job.result}
 
-    comfyui_utils.remove_images(image_ids, image_formats, predefined_path)
\ No newline at end of file
+job_routes.add_job_routes(router, 'comfyui')
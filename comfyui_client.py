@@ -0,0 +1,257 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import websocket
+
+import log
+
+from collections import OrderedDict
+
+from typing import Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+class ComfyUIEvents:
+    """
+    One long-lived websocket connection to ComfyUI shared by every job.
+
+    A background thread reads the event stream, reconnecting when the socket
+    drops, and routes every message carrying a `prompt_id` to the queue of the
+    job waiting on that prompt. Messages for prompts nobody watches yet are kept
+    in a small backlog, so a job that registers right after queueing its prompt
+    still sees the events that arrived in between.
+    """
+
+    # Pseudo message delivered to every watcher after the socket reconnects,
+    # since events sent while it was down are lost
+    RECONNECTED = 'reconnected'
+
+    def __init__(self,
+                 server_address: str,
+                 client_id: str,
+                 reconnect_delay: float = 1.0,
+                 max_reconnect_delay: float = 30.0,
+                 backlog_size: int = 256) -> None:
+        self.server_address = server_address
+        self.client_id = client_id
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.backlog_size = backlog_size
+        self.queue_remaining: Optional[int] = None
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ws: Optional[websocket.WebSocket] = None
+        self._stopped = threading.Event()
+        self._connected: Optional[asyncio.Event] = None
+        self._watchers: Dict[str, asyncio.Queue] = {}
+        self._backlog: "OrderedDict[str, List[dict]]" = OrderedDict()
+
+    def start(self) -> None:
+        """
+        Starts the reader thread. Must be called from the event loop; calling it
+        again once the reader runs is a no-op.
+        """
+        if self._thread is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._connected = asyncio.Event()
+        self._thread = threading.Thread(target=self._run, name='comfyui-events', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._ws is not None:
+            self._ws.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected is not None and self._connected.is_set()
+
+    async def wait_connected(self, timeout: Optional[float] = None) -> None:
+        self.start()
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    def watch(self, prompt_id: str) -> asyncio.Queue:
+        """
+        Registers interest in the events of a prompt.
+
+        Args:
+            prompt_id (str): The prompt id returned by ComfyUI's /prompt.
+
+        Returns:
+            asyncio.Queue: Queue receiving the prompt's messages in order.
+        """
+        queue = asyncio.Queue()
+        for message in self._backlog.pop(prompt_id, []):
+            queue.put_nowait(message)
+        self._watchers[prompt_id] = queue
+        return queue
+
+    def unwatch(self, prompt_id: str) -> None:
+        self._watchers.pop(prompt_id, None)
+
+    def _run(self) -> None:
+        delay = self.reconnect_delay
+        while not self._stopped.is_set():
+            try:
+                self._ws = websocket.WebSocket()
+                self._ws.connect("ws://{}/ws?clientId={}".format(self.server_address, self.client_id))
+                logger.info("CONNECTED TO THE COMFYUI WEBSOCKET")
+                delay = self.reconnect_delay
+                self._loop.call_soon_threadsafe(self._on_connected)
+
+                while not self._stopped.is_set():
+                    self._handle(self._ws.recv())
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logger.warning("COMFYUI WEBSOCKET DISCONNECTED: %s", e)
+            finally:
+                self._loop.call_soon_threadsafe(self._connected.clear)
+                try:
+                    self._ws.close()
+                except Exception:
+                    pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _handle(self, raw) -> None:
+        # Previews are binary data
+        if not isinstance(raw, str):
+            return
+
+        message = json.loads(raw)
+        data = message.get('data') or {}
+
+        if message.get('type') == 'status':
+            exec_info = data.get('status', {}).get('exec_info', {})
+            self.queue_remaining = exec_info.get('queue_remaining', self.queue_remaining)
+            return
+
+        prompt_id = data.get('prompt_id')
+        if prompt_id is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, prompt_id, message)
+
+    def _on_connected(self) -> None:
+        self._connected.set()
+        for queue in self._watchers.values():
+            queue.put_nowait({'type': self.RECONNECTED, 'data': {}})
+
+    def _dispatch(self, prompt_id: str, message: dict) -> None:
+        queue = self._watchers.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(message)
+            return
+
+        self._backlog.setdefault(prompt_id, []).append(message)
+        self._backlog.move_to_end(prompt_id)
+        while len(self._backlog) > self.backlog_size:
+            self._backlog.popitem(last=False)
+
+
+class ComfyUIHttp:
+    """
+    Async client for the ComfyUI REST API.
+
+    Keeps a pool of keep-alive connections to the ComfyUI server so queueing a
+    prompt, reading its history and fetching its outputs reuse the same sockets
+    instead of opening a new connection per call.
+    """
+
+    def __init__(self,
+                 server_address: str,
+                 client_id: str,
+                 timeout: float = 30.0,
+                 max_connections: int = 32) -> None:
+        self.server_address = server_address
+        self.client_id = client_id
+        self.client = httpx.AsyncClient(
+            base_url=f"http://{server_address}",
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def queue_prompt(self, prompt: dict) -> dict:
+        response = await self.client.post("/prompt", json={"prompt": prompt, "client_id": self.client_id})
+        response.raise_for_status()
+        return response.json()
+
+    async def get_history(self, prompt_id: str) -> dict:
+        response = await self.client.get(f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
+
+    async def upload_image(self, data: bytes, filename: str, content_type: str, subfolder: str = '') -> str:
+        """
+        Uploads an input image to ComfyUI's input directory, replacing any
+        image of the same name.
+
+        Returns:
+            str: The name LoadImage nodes refer to the image by.
+        """
+        response = await self.client.post("/upload/image",
+                                          files={"image": (filename, data, content_type)},
+                                          data={"type": "input", "subfolder": subfolder, "overwrite": "true"})
+        response.raise_for_status()
+        uploaded = response.json()
+        return f"{uploaded['subfolder']}/{uploaded['name']}" if uploaded.get('subfolder') else uploaded['name']
+
+    async def cancel_prompt(self, prompt_id: str) -> None:
+        """
+        Removes a pending prompt from ComfyUI's queue, or interrupts it if it is
+        already running.
+        """
+        response = await self.client.get("/queue")
+        response.raise_for_status()
+        running = [item[1] for item in response.json().get('queue_running', [])]
+
+        if prompt_id in running:
+            # Newer ComfyUI only interrupts the given prompt, so ours may
+            # finish first without another user's prompt being stopped
+            response = await self.client.post("/interrupt", json={"prompt_id": prompt_id})
+        else:
+            response = await self.client.post("/queue", json={"delete": [prompt_id]})
+        response.raise_for_status()
+
+    async def get_queue_depth(self) -> int:
+        """
+        Returns the number of prompts ComfyUI is running or has pending.
+        """
+        response = await self.client.get("/queue")
+        response.raise_for_status()
+        queue = response.json()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    async def get_image(self, filename: str, subfolder: str, folder_type: str) -> bytes:
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        response = await self.client.get("/view", params=params)
+        response.raise_for_status()
+        return response.content
+
+    async def get_output_images(self, outputs: dict) -> List[bytes]:
+        """
+        Fetches every image of a finished prompt concurrently.
+
+        Args:
+            outputs (dict): The 'outputs' section of the prompt's history entry.
+
+        Returns:
+            List[bytes]: The raw images, in node and image order.
+        """
+        images = [image
+                  for node_output in outputs.values()
+                  for image in node_output.get('images', [])]
+
+        return list(await asyncio.gather(*[
+            self.get_image(image['filename'], image['subfolder'], image['type'])
+            for image in images
+        ]))
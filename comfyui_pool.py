@@ -0,0 +1,187 @@
+import asyncio
+
+import httpx
+
+import comfyui_client
+import log
+
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = log.get_logger(__name__)
+
+class NoBackendAvailable(Exception):
+    pass
+
+class ComfyUIBackend:
+    """
+    One ComfyUI instance, with its own event socket and HTTP connection pool.
+    """
+
+    def __init__(self,
+                 address: str,
+                 client_id: str,
+                 http_timeout: float,
+                 http_max_connections: int) -> None:
+        self.address = address
+        self.events = comfyui_client.ComfyUIEvents(address, client_id)
+        self.http = comfyui_client.ComfyUIHttp(address,
+                                               client_id,
+                                               timeout=http_timeout,
+                                               max_connections=http_max_connections)
+        self.healthy = True
+        self.failures = 0
+        # Prompts running or pending, from the last /queue poll
+        self.queue_depth = 0
+        # Prompts routed here by this process that haven't finished yet
+        self.assigned = 0
+
+    @property
+    def load(self) -> int:
+        # The event socket has the freshest depth, but it lags behind prompts
+        # that were just routed here and not queued yet
+        depth = self.events.queue_remaining if self.events.connected and self.events.queue_remaining is not None else self.queue_depth
+        return max(depth, self.assigned)
+
+class ComfyUIPool:
+    """
+    Routes prompts over several ComfyUI instances, e.g. one per GPU.
+
+    Every prompt goes to the healthy backend with the least work queued. A
+    background loop polls every backend's /queue; a backend that fails
+    `max_failures` checks or prompts in a row is ejected until a check
+    succeeds again.
+    """
+
+    def __init__(self,
+                 addresses: List[str],
+                 client_id: str,
+                 http_timeout: float = 30.0,
+                 http_max_connections: int = 32,
+                 health_interval: float = 10.0,
+                 max_failures: int = 3) -> None:
+        self.backends = [ComfyUIBackend(address, client_id, http_timeout, http_max_connections)
+                         for address in addresses]
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self._health_task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """
+        Starts the event readers and the health checks. Must be called from the
+        event loop; calling it again is a no-op.
+        """
+        if self._health_task is not None:
+            return
+
+        for backend in self.backends:
+            backend.events.start()
+        self._health_task = log.create_background_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for backend in self.backends:
+            backend.events.stop()
+        await asyncio.gather(*[backend.http.close() for backend in self.backends])
+
+    def mark_failure(self, backend: ComfyUIBackend, error: BaseException) -> None:
+        backend.failures += 1
+        if backend.healthy and backend.failures >= self.max_failures:
+            backend.healthy = False
+            logger.warning("EJECTED COMFYUI BACKEND %s AFTER %s FAILURES: %s", backend.address, backend.failures, error)
+
+    def mark_success(self, backend: ComfyUIBackend) -> None:
+        if not backend.healthy:
+            logger.info("COMFYUI BACKEND %s IS BACK", backend.address)
+        backend.healthy = True
+        backend.failures = 0
+
+    async def check(self, backend: ComfyUIBackend) -> None:
+        try:
+            backend.queue_depth = await backend.http.get_queue_depth()
+            self.mark_success(backend)
+        except Exception as e:
+            self.mark_failure(backend, e)
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.gather(*[self.check(backend) for backend in self.backends])
+            await asyncio.sleep(self.health_interval)
+
+    def select(self, exclude: Tuple[ComfyUIBackend, ...] = ()) -> ComfyUIBackend:
+        """
+        Picks the least loaded healthy backend and counts a prompt against it
+        until `release` is called.
+        """
+        self.start()
+
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            raise NoBackendAvailable("NO HEALTHY COMFYUI BACKEND")
+
+        backend = min(candidates, key=lambda backend: (backend.load, backend.assigned))
+        backend.assigned += 1
+        return backend
+
+    def release(self, backend: ComfyUIBackend) -> None:
+        backend.assigned -= 1
+
+    async def queue_prompt(self,
+                           prompt: dict,
+                           connect_timeout: float,
+                           prepare: Optional[Callable[[ComfyUIBackend, dict], Awaitable[dict]]] = None) -> Tuple[ComfyUIBackend, dict]:
+        """
+        Queues a prompt on the least loaded backend, moving on to the next one
+        if a backend can't be reached. The caller must release the backend once
+        it is done with the prompt.
+
+        `prepare`, if given, is awaited with the chosen backend and the prompt
+        right before queueing, e.g. to upload the prompt's inputs there, and
+        returns the prompt to queue.
+
+        Returns:
+            Tuple[ComfyUIBackend, dict]: The backend and its /prompt response.
+        """
+        tried = ()
+        while True:
+            backend = self.select(tried)
+            try:
+                await backend.events.wait_connected(connect_timeout)
+                prepared = await prepare(backend, prompt) if prepare is not None else prompt
+                response = await backend.http.queue_prompt(prepared)
+                self.mark_success(backend)
+                return backend, response
+            except (asyncio.TimeoutError, httpx.TransportError) as e:
+                self.release(backend)
+                self.mark_failure(backend, e)
+                logger.warning("COULDN'T QUEUE THE PROMPT ON %s: %s", backend.address, e)
+                tried += (backend,)
+            except BaseException:
+                self.release(backend)
+                raise
+
+    async def min_queue_depth(self) -> int:
+        """
+        Returns the load of the least loaded healthy backend, for admission control.
+        """
+        await asyncio.gather(*[self.check(backend) for backend in self.backends if backend.healthy])
+        loads = [backend.load for backend in self.backends if backend.healthy]
+        return min(loads) if loads else 0
+
+    @property
+    def ready(self) -> bool:
+        # A fresh backend counts as healthy until checked, the socket tells it is up
+        return any(backend.healthy and backend.events.connected for backend in self.backends)
+
+    def status(self) -> List[dict]:
+        return [{'address': backend.address,
+                 'healthy': backend.healthy,
+                 'connected': backend.events.connected,
+                 'load': backend.load}
+                for backend in self.backends]
+
+    def loads(self) -> Dict[Tuple[str, ...], int]:
+        return {(backend.address,): backend.load for backend in self.backends}
+
+    def health(self) -> Dict[Tuple[str, ...], int]:
+        return {(backend.address,): int(backend.healthy) for backend in self.backends}
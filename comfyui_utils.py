@@ -1,90 +1,151 @@
+import asyncio
+import hashlib
 import uuid
 import os
-import httpx
-import requests
-import cv2
-import numpy as np
 
-import boto3
+import downloads
+import input_cache
+import log
+import s3_uploader
+import webhooks
 
 from pydantic import BaseModel
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-def upload_images_to_s3(images):
-    print("UPLOADING IMAGES TO S3")
-    s3_client = boto3.client('s3')
+logger = log.get_logger(__name__)
 
-    print("CONNECTED TO THE S3 CLIENT")
-    s3_uris = []
+IMAGE_TYPES = [
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'GIF8', 'gif', 'image/gif'),
+]
 
-    for image_data in images:
-        image_key = str(uuid.uuid4()) + '.png'
+def get_image_type(image_data: bytes) -> Tuple[str, str]:
+    """
+    Detects the format of encoded image bytes from their signature.
 
-        print(f"GOT THE IMAGE KEY: {image_key}")
+    Returns:
+        Tuple[str, str]: The file extension and the content type.
+    """
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    for signature, extension, content_type in IMAGE_TYPES:
+        if image_data.startswith(signature):
+            return extension, content_type
+    # ComfyUI saves PNGs unless told otherwise
+    return 'png', 'image/png'
 
-        image_array = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_UNCHANGED)
-            
-        print(f"SAVING IMAGE ARRAY TO: {image_key}")
+async def upload_image_to_s3(image_data: bytes) -> str:
+    extension, content_type = get_image_type(image_data)
+    image_key = f"{uuid.uuid4()}.{extension}"
 
-        # Save the image as a PNG file
-        cv2.imwrite(image_key, image_array)
+    await s3_uploader.uploader.upload_bytes(image_data, image_key, content_type)
 
-        print("OPENING TMP SAVED IMAGE...")
-        with open(image_key, 'rb') as data:
-            print("OPENED IMAGE")
+    s3_uri = s3_uploader.uploader.uri(image_key)
+    logger.debug("UPLOADED THE IMAGE TO S3: %s", s3_uri)
+    return s3_uri
 
-            print("UPLOADING THE IMAGE TO S3")
-            s3_client.upload_fileobj(data, 'magicalcurie', image_key)
+async def upload_images_to_s3(images: List[bytes]) -> List[str]:
+    """
+    Uploads the images exactly as ComfyUI encoded them, straight from memory
+    and concurrently.
 
-        print(f"UPLOADED THE IMAGE to S3: " + f'https://magicalcurie.s3.amazonaws.com/{image_key}')
-        s3_uris.append(f'https://magicalcurie.s3.amazonaws.com/{image_key}')
+    Args:
+        images (List[bytes]): The encoded images.
 
-        print("REMOVED THE LOCAL IMAGE FILE")
-        # Remove the local image file
-        os.remove(image_key)
+    Returns:
+        List[str]: The S3 URIs of the images, in the same order.
+    """
+    logger.info("UPLOADING %s IMAGES TO S3", len(images))
+    s3_uris = list(await asyncio.gather(*[upload_image_to_s3(image_data) for image_data in images]))
 
-    print(f"URIS FOR IMAGES UPLOADED TO S3: {s3_uris}")
+    logger.info("URIS FOR IMAGES UPLOADED TO S3: %s", s3_uris)
     return s3_uris
 
-def download_and_save_images(
+async def download_and_save_images(
         uploadcare_uris: List[str], 
         image_ids: List[str], 
         image_formats: List[str], 
-        predefined_path: str) -> None:
+        predefined_path: str) -> List[Optional[str]]:
     """
     Downloads and saves images based on image URIs and image IDs.
+    Images without an ID are optional and skipped. Files come from the
+    local input cache when possible.
     Args:
-        uploadcare_uris (List[str]): List of 3 image URIs.
-        image_ids (List[str]): List of 3 image IDs.
+        uploadcare_uris (List[str]): List of image URIs.
+        image_ids (List[str]): List of image IDs.
+        image_formats (List[str]): List of image formats.
         predefined_path (str): Predefined path to save the images.
+    Returns:
+        List[Optional[str]]: Input cache entries pinned for the job, to be released once it is done.
     """
-    print(f"DOWNLOADING AND SAVING OPTIONAL IPA IMAGES")
-    for i in range(2):
-        print(f"DOWNLOAD FOR IPA {i+1}...")
-        image_id = image_ids[i]
-        print(f"GOT THE IMAGE ID: {image_id}")
-
-        image_format = image_formats[i]
-        print(f"GOT THE IMAGE FORMAT: {image_format}")
-        
+    logger.info("DOWNLOADING AND SAVING OPTIONAL IPA IMAGES")
+    images = []
+    for uri, image_id, image_format in zip(uploadcare_uris, image_ids, image_formats):
         if image_id:
-            print("IMAGE ID IS DEFINED")
-            print(f"SETTING THE UNIQUE FILEPATH OF THE IMAGE")
             image_path = os.path.join(predefined_path, f"{image_id}.{image_format}")
+            logger.debug("DOWNLOADING IMAGE %s TO %s", uri, image_path)
+            images.append((uri, image_path))
+
+    digests = await input_cache.cache.link_all(images)
+    logger.info("SAVED %s IPA IMAGES", len(images))
+
+    return digests
 
-            print(f"DOWNLOADING IMAGE FROM {image_path}")
-            response = requests.get(uploadcare_uris[i])
+async def fetch_images(
+        uploadcare_uris: List[str],
+        image_ids: List[str],
+        image_formats: List[str]) -> List[Tuple[str, bytes, str]]:
+    """
+    Downloads the job's images into memory, for staging them through
+    ComfyUI's upload API instead of a shared directory.
+    Images without an ID are optional and skipped.
+    Args:
+        uploadcare_uris (List[str]): List of image URIs.
+        image_ids (List[str]): List of image IDs.
+        image_formats (List[str]): List of image formats.
+    Returns:
+        List[Tuple[str, bytes, str]]: File name the workflow uses, content and SHA-256 of every image.
+    """
+    names = []
+    uris = []
+    for uri, image_id, image_format in zip(uploadcare_uris, image_ids, image_formats):
+        if image_id:
+            names.append(f"{image_id}.{image_format}")
+            uris.append(uri)
 
-            if response.status_code == 200:
-                print("GOT THE IPA IMAGE FROM UPLOADCARE")
-                with open(image_path, "wb") as f:
-                    f.write(response.content)
-                print(f"SAVED IMAGE TO {image_path}")
-            else:
-                print(f"FAILED TO GET UPLOADCARE IMAGE: {uploadcare_uris[i]}")
-        else:
-            print(f"NO IMAGE FOUND FOR IPA {i+1}")
+    contents = await asyncio.gather(*[downloads.downloader.fetch(uri) for uri in uris])
+    logger.info("FETCHED %s IPA IMAGES", len(contents))
+
+    return [(name, data, hashlib.sha256(data).hexdigest()) for name, data in zip(names, contents)]
+
+async def upload_images_to_comfyui(http, images: List[Tuple[str, bytes, str]], subfolder: str) -> Dict[str, str]:
+    """
+    Uploads fetched images to a ComfyUI backend under content-addressed names,
+    so resubmitting an image replaces the earlier copy instead of adding one.
+    Returns:
+        Dict[str, str]: ComfyUI's name for every file name the workflow uses.
+    """
+    async def upload(name: str, data: bytes, digest: str) -> str:
+        extension, content_type = get_image_type(data)
+        return await http.upload_image(data, f"{digest}.{extension}", content_type, subfolder)
+
+    uploaded = await asyncio.gather(*[upload(name, data, digest) for name, data, digest in images])
+    return {name: uploaded_name for (name, _, _), uploaded_name in zip(images, uploaded)}
+
+def patch_image_inputs(workflow: dict, names: Dict[str, str]) -> dict:
+    """
+    Points the LoadImage nodes (and any other node input naming an input file)
+    at the uploaded images. Only the patched nodes are copied.
+    """
+    patched = dict(workflow)
+    for node_id, node in workflow.items():
+        inputs = node.get('inputs', {})
+        changes = {key: names[value] for key, value in inputs.items() if isinstance(value, str) and value in names}
+        if changes:
+            patched[node_id] = dict(node, inputs=dict(inputs, **changes))
+    return patched
 
 def remove_images(
         image_ids: List[str],
@@ -93,27 +154,19 @@ def remove_images(
     """
     Removes images based on image IDs.
     Args:
-        image_ids (Dict[str, str]): Dictionary of image IDs.
+        image_ids (List[str]): List of image IDs.
+        image_formats (List[str]): List of image formats.
         predefined_path (str): Predefined path where the images are stored.
     """
-    print(f"REMOVING IMAGES")
-    for i in range(2):
-        print(f"GETTING IMAGE ID")
-        image_id = image_ids[i]
-
+    logger.debug("REMOVING IMAGES")
+    for image_id, image_format in zip(image_ids, image_formats):
         if image_id:
-            print("IMAGE ID IS DEFINED")
-
-            image_format = image_formats[i]
-            print(f"GOT THE IMAGE FORMAT: {image_format}")
-
             image_path = os.path.join(predefined_path, f"{image_id}.{image_format}")
             try:
-                print(f"REMOVING IMAGE FROM {image_path}...")
                 os.remove(image_path)
-                print(f"IMAGE REMOVED: {image_path}")
+                logger.debug("IMAGE REMOVED: %s", image_path)
             except FileNotFoundError:
-                print(f"IMAGE FOR REMOVAL NOT FOUND: {image_path}")
+                logger.debug("IMAGE FOR REMOVAL NOT FOUND: %s", image_path)
 
 class Message(BaseModel):
     user_id: Optional[str] = None
@@ -123,15 +176,24 @@ class Message(BaseModel):
     message_id: Optional[str] = None
     settings_id: Optional[str] = None
     s3_uris: Optional[List[str]] = None
+    timings: Optional[Dict[str, float]] = None
+    progress: Optional[dict] = None
+    batch_index: Optional[int] = None
+    batch_s3_uris: Optional[List[List[str]]] = None
 
 async def send_webhook_acknowledgment(user_id: str, 
                                       message_id: str, 
                                       settings_id: str, 
                                       status: str, 
                                       webhook_url: str, 
-                                      s3_uris: Optional[List[str]] = None) -> None:
+                                      s3_uris: Optional[List[str]] = None,
+                                      timings: Optional[Dict[str, float]] = None,
+                                      progress: Optional[dict] = None,
+                                      batch_index: Optional[int] = None,
+                                      batch_s3_uris: Optional[List[List[str]]] = None) -> None:
     """
-    Sends an acknowledgment message via webhook.
+    Sends an acknowledgment message via webhook. The message is queued on the
+    webhook outbox, which delivers and retries it in the background.
 
     Args:
         user_id (str): The unique identifier for the user.
@@ -139,11 +201,15 @@ async def send_webhook_acknowledgment(user_id: str,
         status (str): The status of the message.
         webhook_url (str): The URL of the webhook endpoint.
         s3_uris (Optional[List[str]]): The S3 URIs associated with the message.
+        timings (Optional[Dict[str, float]]): Per-stage timings of the job, sent when WEBHOOK_INCLUDE_TIMINGS is set.
+        progress (Optional[dict]): The latest progress of a running job.
+        batch_index (Optional[int]): Index of the batch item the message is about, for per-item batch webhooks.
+        batch_s3_uris (Optional[List[List[str]]]): The S3 URIs of every item of a finished batch.
 
     Returns:
         None
     """
-    print("SENDING WEBHOOK ACKNOWLEDGMENT")
+    logger.debug("SENDING WEBHOOK ACKNOWLEDGMENT")
     try:
         # Create a dictionary to store the fields
         message_fields = {
@@ -153,24 +219,28 @@ async def send_webhook_acknowledgment(user_id: str,
             'status': status
         }
 
-        print(f"CREATED DICTIONARY TO STORE THE FIELDS: {message_fields}")
-        
         if s3_uris is not None:
-            print("S3 URIS NOT NULL")
-
-            print("ADDING S3_URIS FIELD TO MESSAGE MODEL")
             message_fields['s3_uris'] = s3_uris
 
-        print("CREATING MESSAGE MODEL")
+        if timings is not None and os.getenv('WEBHOOK_INCLUDE_TIMINGS'):
+            message_fields['timings'] = timings
+
+        if progress is not None:
+            message_fields['progress'] = progress
+
+        # Items of a batch are separate notifications, so they don't replace each other
+        webhook_key = str(message_id)
+        if batch_index is not None:
+            message_fields['batch_index'] = batch_index
+            webhook_key = f"{message_id}/{batch_index}"
+
+        if batch_s3_uris is not None:
+            message_fields['batch_s3_uris'] = batch_s3_uris
+
         # Create the Message object
         message = Message(**message_fields)
 
-        print(f"MAKING POST REQUEST TO THE WEBHHOK {webhook_url}")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(webhook_url, json=message.__dict__)
-            if response.status_code == 200:
-                print("WEBHOOK POST REQUEST WAS SUCCESSFUL")
-            else:
-                print(f"WEBHOOK POST REQUEST FAILED: {response.status_code}")
+        logger.info("QUEUEING %s WEBHOOK TO %s", status, webhook_url)
+        webhooks.outbox.send(webhook_url, webhook_key, message.__dict__)
     except Exception as e:
-        print(f"ERROR WHILE SETTING UP WEBHOOK POST REQUEST: {str(e)}")
\ No newline at end of file
+        logger.exception("ERROR WHILE SETTING UP WEBHOOK POST REQUEST: %s", e)
\ No newline at end of file
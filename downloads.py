@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+import httpx
+
+import jobs
+import metrics
+
+from typing import List, Optional, Tuple
+
+class DownloadError(Exception):
+    pass
+
+class Downloader:
+    """
+    Streams input files to disk over a shared connection pool.
+
+    Bodies are written chunk by chunk, so memory use stays at one chunk per
+    download no matter how large the file is, and every file of a job is
+    fetched concurrently.
+    """
+
+    def __init__(self,
+                 max_bytes: int,
+                 timeout: float = 30.0,
+                 chunk_size: int = 1024 * 1024,
+                 max_connections: int = 32) -> None:
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            follow_redirects=True)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def download(self, uri: str, path: str, max_bytes: Optional[int] = None) -> int:
+        """
+        Downloads a file to the given path.
+
+        Args:
+            uri (str): The URI of the file.
+            path (str): Where to save the file.
+            max_bytes (Optional[int]): Size limit overriding the downloader default.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        max_bytes = max_bytes or self.max_bytes
+        written = 0
+
+        try:
+            async with self.client.stream('GET', uri) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f"FAILED TO DOWNLOAD {uri}: {response.status_code}")
+
+                content_length = int(response.headers.get('content-length', 0))
+                if content_length > max_bytes:
+                    raise DownloadError(f"FILE {uri} IS TOO LARGE: {content_length} BYTES")
+
+                with open(path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        written += len(chunk)
+                        if written > max_bytes:
+                            raise DownloadError(f"FILE {uri} IS LARGER THAN {max_bytes} BYTES")
+                        await jobs.engine.run_blocking(f.write, chunk)
+                        metrics.DOWNLOAD_BYTES.inc(len(chunk))
+        except BaseException:
+            # Never leave a partial file behind
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        return written
+
+    async def fetch(self, uri: str, max_bytes: Optional[int] = None) -> bytes:
+        """
+        Downloads a small file into memory.
+
+        Args:
+            uri (str): The URI of the file.
+            max_bytes (Optional[int]): Size limit overriding the downloader default.
+
+        Returns:
+            bytes: The content of the file.
+        """
+        max_bytes = max_bytes or self.max_bytes
+        data = bytearray()
+
+        async with self.client.stream('GET', uri) as response:
+            if response.status_code != 200:
+                raise DownloadError(f"FAILED TO DOWNLOAD {uri}: {response.status_code}")
+
+            content_length = int(response.headers.get('content-length', 0))
+            if content_length > max_bytes:
+                raise DownloadError(f"FILE {uri} IS TOO LARGE: {content_length} BYTES")
+
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                data += chunk
+                if len(data) > max_bytes:
+                    raise DownloadError(f"FILE {uri} IS LARGER THAN {max_bytes} BYTES")
+                metrics.DOWNLOAD_BYTES.inc(len(chunk))
+
+        return bytes(data)
+
+    async def download_all(self, downloads: List[Tuple[str, str]]) -> List[int]:
+        """
+        Downloads several (uri, path) pairs concurrently.
+
+        Returns:
+            List[int]: The number of bytes written for every file.
+        """
+        return list(await asyncio.gather(*[self.download(uri, path) for uri, path in downloads]))
+
+
+downloader = Downloader(
+    max_bytes=int(os.getenv('DOWNLOAD_MAX_BYTES', str(2 * 1024 ** 3))),
+    timeout=float(os.getenv('DOWNLOAD_TIMEOUT', '60')),
+    chunk_size=int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(1024 * 1024))),
+    max_connections=int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', '32')))
@@ -1,41 +1,109 @@
+import asyncio
 import uuid
 import os
+import shlex
+import shutil
 
-import subprocess
-
-from fastapi import Request, APIRouter
+from fastapi import Request, APIRouter, HTTPException
 
 from uuid import uuid4
 
+import facefusion_pool
 import facefusion_utils
+import input_cache
+import job_routes
+import jobs
+import log
+import metrics
+import preprocessing
+import progress
+import video_segments
 
 router = APIRouter(prefix="/facefusion")
 
-def run_facefusion(file_ids, file_formats, predefined_path):
-    print("INITIALIZING PYTHON COMMAND")
+logger = log.get_logger(__name__)
 
-    activate_env = "conda activate facefusion"
+FACEFUSION_DIR = os.getenv('FACEFUSION_DIR', '/workspace/miniconda3/envs/facefusion')
 
-    run_command = [
-        "python3", "/workspace/miniconda3/envs/facefusion/run.py",
-        "--headless",
-        "--execution-providers cuda",
-        "--execution-thread-count 128",
-        "--execution-queue-count 32",
-        "--video-memory-strategy tolerant",
-        "--frame-processors face_swapper face_enhancer",
-        "--reference-face-distance 1.5",
-        "--output-video-preset ultrafast"
-    ]
+FACEFUSION_ARGS = [
+    "--execution-providers", "cuda",
+    "--execution-thread-count", "128",
+    "--execution-queue-count", "32",
+    "--video-memory-strategy", "tolerant",
+    "--frame-processors", "face_swapper", "face_enhancer",
+    "--reference-face-distance", "1.5",
+    "--output-video-preset", "ultrafast"
+]
 
+# Where the job's inputs and outputs are kept while it runs
+FILES_DIR = os.getenv('FACEFUSION_FILES_DIR', '/workspace/files/')
 
-    sources = ""
-    for source_id, source_format in zip(file_ids[:-1], file_formats[:-1]):
-        source_path = os.path.join(predefined_path, f"{source_id}.{source_format}")
-        sources += source_path + " "
+# Video targets are split into this many segments processed in parallel, 1 disables it
+SEGMENTS = int(os.getenv('FACEFUSION_SEGMENTS', '1'))
+# Most segments a request may ask for, one per worker by default
+MAX_SEGMENTS = int(os.getenv('FACEFUSION_MAX_SEGMENTS', os.getenv('FACEFUSION_WORKERS', '1')))
+
+def create_worker_pool():
+    # The workers run with the python of the facefusion conda env, which is
+    # what `conda activate facefusion` used to put on the PATH
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(FACEFUSION_DIR, 'bin') + os.pathsep + env.get('PATH', '')
+
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'facefusion_worker.py')
+    command = os.getenv('FACEFUSION_WORKER_COMMAND')
+    if command:
+        command = shlex.split(command)
+    else:
+        command = [os.path.join(FACEFUSION_DIR, 'bin', 'python'), worker_script] + FACEFUSION_ARGS
 
-    run_command.extend([f"--source {sources}"])
+    job_timeout = os.getenv('FACEFUSION_JOB_TIMEOUT')
 
+    return facefusion_pool.FaceFusionPool(
+        size=int(os.getenv('FACEFUSION_WORKERS', '1')),
+        command=command,
+        cwd=FACEFUSION_DIR if os.path.isdir(FACEFUSION_DIR) else None,
+        env=env,
+        start_timeout=float(os.getenv('FACEFUSION_WORKER_START_TIMEOUT', '300')),
+        job_timeout=float(job_timeout) if job_timeout else None,
+        health_interval=float(os.getenv('FACEFUSION_HEALTH_INTERVAL', '30')))
+
+workers = create_worker_pool()
+
+def resolve_segments(segments=None) -> int:
+    """
+    Returns the number of segments to split a job's video target into, capped
+    to MAX_SEGMENTS.
+
+    Raises:
+        ValueError: If `segments` isn't a positive integer.
+    """
+    if segments is None:
+        segments = SEGMENTS
+    elif isinstance(segments, bool) or not isinstance(segments, (int, str)):
+        raise ValueError(f"SEGMENTS MUST BE A POSITIVE INTEGER, GOT {segments!r}")
+    try:
+        segments = int(segments)
+    except ValueError:
+        raise ValueError(f"SEGMENTS MUST BE A POSITIVE INTEGER, GOT {segments!r}")
+    if segments < 1:
+        raise ValueError(f"SEGMENTS MUST BE A POSITIVE INTEGER, GOT {segments!r}")
+    return min(segments, max(MAX_SEGMENTS, 1))
+
+def build_facefusion_args(file_ids, file_formats, predefined_path):
+    """
+    Builds the FaceFusion arguments of a job. The last file is the target,
+    the others are the sources.
+
+    Returns:
+        Tuple[List[str], str]: The arguments and the path of the output file.
+    """
+    args = list(FACEFUSION_ARGS)
+
+    sources = []
+    for source_id, source_format in zip(file_ids[:-1], file_formats[:-1]):
+        sources.append(os.path.join(predefined_path, f"{source_id}.{source_format}"))
+
+    args.extend(["--source"] + sources)
 
     # The last file is assumed to be the target
     target_path = os.path.join(predefined_path, f"{file_ids[-1]}.{file_formats[-1]}")
@@ -45,57 +113,188 @@ def run_facefusion(file_ids, file_formats, predefined_path):
     output_format = file_formats[-1]  # Assuming output format is the same as the target's format
     output_path = os.path.join(predefined_path, f"{output_id}.{output_format}")
 
-    # Complete the command with target and output paths
-    run_command.extend([f"--target {target_path}", f"--output {output_path}"])
-    
-    # Combine commands to run in the same subprocess
-    full_command = f"{activate_env} && " + " ".join(run_command)
+    args.extend(["--target", target_path, "--output", output_path])
+
+    return args, output_path
+
+async def run_facefusion(file_ids, file_formats, predefined_path, tracker=None):
+    args, output_path = build_facefusion_args(file_ids, file_formats, predefined_path)
 
-    print(full_command)
-    
-    print("RUNNING THE PROCESS AND CALLING FACEFUSION")
-    
-    # Execute the full command within the Conda environment
-    subprocess.run(full_command, shell=True, check=True)
+    async def on_progress(frame, frames):
+        if tracker is not None:
+            await tracker.update(frame=frame, frames=frames)
+
+    logger.info("RUNNING FACEFUSION ON A WARM WORKER: %s", log.truncate(' '.join(args)))
+    try:
+        await workers.run(args, on_progress)
+    except BaseException:
+        # A cancelled or failed run may leave a partial output behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
 
     return output_path
 
-@router.post("/")
-async def generate_deepfake(request: Request):
-    print("EXTRACTING PAYLOAD")
-    payload = await request.json()
-    source_uris = payload.get('source_uris', {})
-    target_uri = payload.get('target_uri', {})
-    file_formats = payload.get('file_formats', {})
-    job_id = payload.get('job_id', {})
-    user_id = payload.get('user_id', {})
+async def run_facefusion_segmented(file_ids, file_formats, predefined_path, segments, tracker=None):
+    """
+    Runs FaceFusion on a video target split at keyframes into `segments`
+    parts, which are processed concurrently on the pool's workers and joined
+    again without re-encoding. The audio is copied from the original target.
+    """
+    args, output_path = build_facefusion_args(file_ids, file_formats, predefined_path)
+    target_path = args[args.index('--target') + 1]
+    extension = os.path.splitext(output_path)[1]
 
-    file_ids = []
+    work_dir = os.path.join(predefined_path, f"segments-{uuid.uuid4()}")
+    os.makedirs(work_dir)
+    try:
+        parts = await video_segments.split(target_path, segments, work_dir)
 
-    uris = source_uris.extended(target_uri)
+        # Latest (frame, frames) of every segment, reported as one total
+        frames = {}
 
-    for _ in uris:
-        file_ids.append(str(uuid4()))
+        async def run_part(index, part):
+            part_output = os.path.join(work_dir, f"output-{index:03d}{extension}")
+            part_args = list(args)
+            part_args[part_args.index('--target') + 1] = part
+            part_args[part_args.index('--output') + 1] = part_output
+
+            async def on_progress(frame, total):
+                frames[index] = (frame, total)
+                if tracker is not None:
+                    await tracker.update(frame=sum(f for f, _ in frames.values()),
+                                         frames=sum(t for _, t in frames.values()),
+                                         segments=len(parts))
+
+            await workers.run(part_args, on_progress)
+            return part_output
+
+        logger.info("RUNNING FACEFUSION ON %s SEGMENTS: %s", len(parts), log.truncate(' '.join(args)))
+        tasks = [asyncio.create_task(run_part(index, part)) for index, part in enumerate(parts)]
+        try:
+            outputs = await asyncio.gather(*tasks)
+        except BaseException:
+            # Free the workers still busy with the other segments
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        await video_segments.concat(outputs, target_path, output_path, work_dir)
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        await jobs.engine.run_blocking(shutil.rmtree, work_dir, True)
+
+    return output_path
+
+async def preprocess_sources(file_ids, file_formats, digests, predefined_path, max_side):
+    """
+    Downscales the source faces in place. The target is left alone, its
+    resolution is the output's.
+    """
+    async def preprocess(file_id, file_format, digest):
+        path = os.path.join(predefined_path, f"{file_id}.{file_format}")
+        if digest is None:
+            # The input cache is disabled
+            digest = await jobs.engine.run_blocking(input_cache.hash_file, path)
+        await preprocessing.preprocessor.process_file(path, digest, max_side)
+
+    await asyncio.gather(*[preprocess(file_id, file_format, digest)
+                           for file_id, file_format, digest in zip(file_ids[:-1], file_formats[:-1], digests[:-1])])
+
+async def run_deepfake(job: jobs.Job,
+                       uris: list,
+                       file_ids: list,
+                       file_formats: list,
+                       job_id: str,
+                       user_id: str,
+                       segments: int = 1,
+                       max_input_side: int = 0):
+    log.user_id.set(user_id)
 
     await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'in progress')
 
+    predefined_path = FILES_DIR
+    digests = []
+
     try:
-        predefined_path = '/workspace/files/'
+        with metrics.timed(job, 'download'):
+            digests = await facefusion_utils.download_and_save_files(uris, file_ids, file_formats, predefined_path)
+
+        if max_input_side > 0:
+            with metrics.timed(job, 'preprocess'):
+                await preprocess_sources(file_ids, file_formats, digests, predefined_path, max_input_side)
+
+        async def notify(event):
+            await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'in progress', progress=event)
+
+        tracker = progress.ProgressTracker(job, notify, progress.WEBHOOK_INTERVAL)
 
-        facefusion_utils.download_and_save_files(uris, file_ids, file_formats, predefined_path)
+        target_path = os.path.join(predefined_path, f"{file_ids[-1]}.{file_formats[-1]}")
 
-        output_path = run_facefusion(file_ids,
-                                     file_formats,
-                                     predefined_path)
+        with metrics.timed(job, 'facefusion'):
+            if segments > 1 and video_segments.is_video(target_path):
+                output_path = await run_facefusion_segmented(file_ids,
+                                                             file_formats,
+                                                             predefined_path,
+                                                             segments,
+                                                             tracker)
+            else:
+                output_path = await run_facefusion(file_ids,
+                                                   file_formats,
+                                                   predefined_path,
+                                                   tracker)
 
         if output_path:
-            s3_uri = facefusion_utils.upload_file_to_s3(output_path)
+            with metrics.timed(job, 'upload'):
+                s3_uri = await facefusion_utils.upload_file_to_s3(output_path)
 
-            await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'completed', s3_uri)
+            await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'completed', s3_uri, timings=job.timings)
+
+            return s3_uri
         else:
             raise Exception("GENERATED NO VIDEO DEEPFAKES")
+    except asyncio.CancelledError:
+        await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'cancelled')
+        raise
     except Exception as e:
-        print(e)
+        logger.error("ERROR: %s", e)
         await facefusion_utils.send_webhook_acknowledgment(user_id, job_id, 'failed')
+        raise
+    finally:
+        await jobs.engine.run_blocking(facefusion_utils.remove_files, file_ids, file_formats, predefined_path)
+        input_cache.cache.release(digests)
+
+@router.post("/", status_code=202)
+async def generate_deepfake(request: Request):
+    payload = await request.json()
+    source_uris = payload.get('source_uris', [])
+    target_uri = payload.get('target_uri', {})
+    file_formats = payload.get('file_formats', {})
+    job_id = payload.get('job_id', {})
+    user_id = payload.get('user_id', {})
+    try:
+        segments = resolve_segments(payload.get('segments'))
+        max_input_side = preprocessing.preprocessor.cap(payload.get('max_input_side'))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    file_ids = []
+
+    # The target is always the last file
+    uris = source_uris + [target_uri]
+
+    for _ in uris:
+        file_ids.append(str(uuid4()))
+
+    # A retried request with the same job id gets the job of the first one
+    job = jobs.engine.submit('facefusion', run_deepfake, uris, file_ids, file_formats, job_id, user_id, segments, max_input_side,
+                             user_id=user_id, priority=payload.get('priority', 'normal'),
+                             idempotency_key=str(job_id) if job_id else None)
+
+    return {'job_id': job.job_id, 'status': job.status, 'result': job.result}
 
-    facefusion_utils.remove_files(file_ids, file_formats, predefined_path)
\ No newline at end of file
+job_routes.add_job_routes(router, 'facefusion')
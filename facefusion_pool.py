@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import re
+import signal
+
+import log
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+# FaceFusion reports frames through tqdm, e.g. "Processing:  45%|####5     | 450/1000 [00:10<00:12, ...]"
+PROGRESS_PATTERN = re.compile(r'(\d+)/(\d+) \[')
+
+class FaceFusionError(Exception):
+    pass
+
+class FaceFusionWorker:
+    """
+    Host side of one persistent facefusion_worker.py process.
+    """
+
+    def __init__(self, index: int, command: List[str], cwd: Optional[str], env: Dict[str, str]) -> None:
+        self.index = index
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # Held while the worker runs a job or answers a health check
+        self.lock = asyncio.Lock()
+        # Called with (frame, frames) while a job runs
+        self.on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+        self._stderr_task: Optional[asyncio.Task] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self, timeout: float) -> None:
+        logger.info("STARTING FACEFUSION WORKER %s", self.index)
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self.cwd,
+            env=self.env,
+            # Own process group, so the worker and its children can be killed together
+            start_new_session=True)
+        self._stderr_task = log.create_background_task(self._read_stderr(self.process.stderr))
+
+        reply = await asyncio.wait_for(self._read(), timeout)
+        if reply['type'] != 'ready':
+            raise FaceFusionError(f"FACEFUSION WORKER {self.index} DID NOT START: {reply}")
+        logger.info("FACEFUSION WORKER %s IS READY", self.index)
+
+    async def stop(self) -> None:
+        if not self.alive:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(self.process.wait(), 10)
+        except asyncio.TimeoutError:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            await self.process.wait()
+
+    async def _read_stderr(self, stderr: asyncio.StreamReader) -> None:
+        """
+        Reads FaceFusion's output, forwarding frame progress and logging the rest.
+        tqdm redraws its bar with carriage returns, so lines end in either.
+        """
+        buffer = b''
+        while True:
+            chunk = await stderr.read(4096)
+            if not chunk:
+                return
+            buffer += chunk
+            *lines, buffer = re.split(rb'[\r\n]', buffer)
+            for line in lines:
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                match = PROGRESS_PATTERN.search(line)
+                if match:
+                    if self.on_progress is not None:
+                        await self.on_progress(int(match.group(1)), int(match.group(2)))
+                else:
+                    logger.debug("FACEFUSION WORKER %s: %s", self.index, log.truncate(line))
+
+    async def _read(self) -> dict:
+        line = await self.process.stdout.readline()
+        if not line:
+            raise FaceFusionError(f"FACEFUSION WORKER {self.index} EXITED WITH CODE {await self.process.wait()}")
+        return json.loads(line)
+
+    async def _request(self, message: dict, timeout: Optional[float]) -> dict:
+        self.process.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+        await self.process.stdin.drain()
+        return await asyncio.wait_for(self._read(), timeout)
+
+    async def run(self, args: List[str], timeout: Optional[float]) -> None:
+        reply = await self._request({'type': 'run', 'args': args}, timeout)
+        if reply['type'] == 'error':
+            raise FaceFusionError(reply['error'])
+
+    async def ping(self, timeout: float) -> bool:
+        try:
+            return (await self._request({'type': 'ping'}, timeout))['type'] == 'pong'
+        except Exception:
+            return False
+
+class FaceFusionPool:
+    """
+    Pool of persistent FaceFusion worker processes.
+
+    Every worker loads FaceFusion and its models once and then takes jobs over
+    its stdin/stdout pipes, so a job no longer pays for conda activation,
+    interpreter startup and model loading. Idle workers are health checked
+    periodically, and a worker that crashes, times out or fails a health check
+    is restarted.
+    """
+
+    def __init__(self,
+                 size: int,
+                 command: List[str],
+                 cwd: Optional[str] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 start_timeout: float = 300.0,
+                 job_timeout: Optional[float] = None,
+                 health_interval: float = 30.0) -> None:
+        self.start_timeout = start_timeout
+        self.job_timeout = job_timeout
+        self.health_interval = health_interval
+        self.workers = [FaceFusionWorker(i, command, cwd, env or dict(os.environ)) for i in range(size)]
+        self._idle: Optional[asyncio.Queue] = None
+        self._starting: Optional[asyncio.Future] = None
+        self._health_task: Optional[asyncio.Task] = None
+        # Restarts of cancelled workers, running in the background
+        self._restarts = set()
+
+    async def start(self) -> None:
+        """
+        Starts every worker. Safe to call repeatedly; callers share one startup.
+        """
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._starting)
+
+    async def _start(self) -> None:
+        self._idle = asyncio.Queue()
+        for worker in self.workers:
+            self._idle.put_nowait(worker)
+
+        await asyncio.gather(*[self._restart(worker) for worker in self.workers])
+        self._health_task = log.create_background_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for task in list(self._restarts):
+            task.cancel()
+        await asyncio.gather(*[worker.stop() for worker in self.workers])
+
+    async def _restart(self, worker: FaceFusionWorker) -> None:
+        await worker.stop()
+        try:
+            await worker.start(self.start_timeout)
+        except Exception as e:
+            # The health check or the next job will try again
+            logger.error("FAILED TO START FACEFUSION WORKER %s: %s", worker.index, e)
+            await worker.stop()
+
+    async def _restart_in_background(self, worker: FaceFusionWorker) -> None:
+        async with worker.lock:
+            # A job may have taken the worker and started it first
+            if not worker.alive:
+                await self._restart(worker)
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in self.workers:
+                if worker.lock.locked():
+                    continue
+                async with worker.lock:
+                    if not worker.alive or not await worker.ping(self.health_interval):
+                        logger.warning("FACEFUSION WORKER %s IS UNHEALTHY - RESTARTING", worker.index)
+                        await self._restart(worker)
+
+    @property
+    def ready(self) -> bool:
+        return any(worker.alive for worker in self.workers)
+
+    def status(self) -> List[dict]:
+        return [{'worker': worker.index, 'alive': worker.alive, 'busy': worker.lock.locked()}
+                for worker in self.workers]
+
+    async def run(self,
+                  args: List[str],
+                  on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> None:
+        """
+        Runs one FaceFusion job on the next free worker.
+
+        Args:
+            args (List[str]): FaceFusion command line arguments of the job.
+            on_progress (Optional[Callable]): Called with (frame, frames) as FaceFusion reports progress.
+        """
+        await self.start()
+
+        worker = await self._idle.get()
+        try:
+            async with worker.lock:
+                if not worker.alive:
+                    await self._restart(worker)
+                if not worker.alive:
+                    raise FaceFusionError(f"FACEFUSION WORKER {worker.index} IS NOT RUNNING")
+
+                worker.on_progress = on_progress
+                try:
+                    await worker.run(args, self.job_timeout)
+                except FaceFusionError:
+                    if not worker.alive:
+                        await self._restart(worker)
+                    raise
+                except asyncio.CancelledError:
+                    # Kill the process group to free the GPU now, and load the
+                    # models again before the next job needs the worker
+                    await worker.stop()
+                    task = log.create_background_task(self._restart_in_background(worker))
+                    self._restarts.add(task)
+                    task.add_done_callback(self._restarts.discard)
+                    raise
+                except BaseException:
+                    # A timed out job leaves the worker mid-job
+                    await self._restart(worker)
+                    raise
+                finally:
+                    worker.on_progress = None
+        finally:
+            self._idle.put_nowait(worker)
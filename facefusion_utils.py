@@ -1,14 +1,18 @@
 import os
-import httpx
-import requests
+import mimetypes
 
-import boto3
+import input_cache
+import log
+import s3_uploader
+import webhooks
 
 from datetime import datetime
 
 from pydantic import BaseModel, Field
 
-from typing import List, Optional
+from typing import Dict, List, Optional
+
+logger = log.get_logger(__name__)
 
 class Message(BaseModel):
     user_id: str
@@ -20,46 +24,38 @@ class Message(BaseModel):
     # face_enhancer_model: Optional[str] = None
     # frame_enhancer_blend: Optional[int] = None
     s3_uris: Optional[List[str]] = None
+    # The output of a completed job
+    s3_uri: Optional[str] = None
+    timings: Optional[Dict[str, float]] = None
+    progress: Optional[dict] = None
 
 
-def download_and_save_files(uris: List[str], 
-                            file_ids: List[str],
-                            file_formats: List[str],
-                            predefined_path: str) -> None:
+async def download_and_save_files(uris: List[str], 
+                                  file_ids: List[str],
+                                  file_formats: List[str],
+                                  predefined_path: str) -> List[Optional[str]]:
     """
     Downloads and saves files based on file URIs and file IDs.
+    Files come from the local input cache when possible.
     Args:
-        uploadcare_uris (List[str]): List of file URIs.
+        uris (List[str]): List of file URIs.
         file_ids (List[str]): List of file IDs.
+        file_formats (List[str]): List of file formats.
         predefined_path (str): Predefined path to save the files.
-        file_format (str): The format of the files to be saved.
+    Returns:
+        List[Optional[str]]: Input cache entries pinned for the job, to be released once it is done.
     """
-    print(f"DOWNLOADING AND SAVING FILES FOR FACEFUSION")
-    for i in range(3):
-        print(f"DOWNLOAD FOR FILE {i+1}...")
-
-        file_uri = uris[i]
-        print(f"GOT THE FILE URI: {file_uri}")
-
-        file_id = file_ids[i]
-        print(f"GOT THE FILE ID: {file_id}")
-
-        file_format = file_formats[i]
-        print(f"GOT THE FILE FORMAT: {file_format}")
-
-        print(f"SETTING THE UNIQUE FILEPATH OF THE FILE")
+    logger.info("DOWNLOADING AND SAVING FILES FOR FACEFUSION")
+    files = []
+    for file_uri, file_id, file_format in zip(uris, file_ids, file_formats):
         file_path = os.path.join(predefined_path, f"{file_id}.{file_format}")
+        logger.debug("DOWNLOADING FILE %s TO %s", file_uri, file_path)
+        files.append((file_uri, file_path))
 
-        print(f"DOWNLOADING FILE FROM {file_uri}")
-        response = requests.get(file_uri)
+    digests = await input_cache.cache.link_all(files)
+    logger.info("SAVED %s FILES", len(files))
 
-        if response.status_code == 200:
-            print(f"GOT THE FILE FROM UPLOADCARE")
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            print(f"SAVED FILE TO {file_path}")
-        else:
-            print(f"NO FILE FOUND FOR {file_uri}")
+    return digests
 
 
 def remove_files(
@@ -70,55 +66,53 @@ def remove_files(
     Removes files based on file IDs.
     Args:
         file_ids (List[str]): List of file IDs.
+        file_formats (List[str]): List of file formats.
         predefined_path (str): Predefined path where the files are stored.
     """
-    print(f"REMOVING FILES")
-    for i in range(3):
-        print(f"GETTING FILE ID")
-        file_id = file_ids[i]
-
-        file_format = file_formats[i]
-        print(f"GOT THE GOT THE FILE FORMAT: {file_format}")
-
-        print(f"SETTING THE UNIQUE FILEPATH OF THE FILE")
+    logger.debug("REMOVING FILES")
+    for file_id, file_format in zip(file_ids, file_formats):
         file_path = os.path.join(predefined_path, f"{file_id}.{file_format}")
         try:
-            print(f"REMOVING A FILE")
             os.remove(file_path)
-            print(f"FILE REMOVED: {file_path}")
+            logger.debug("FILE REMOVED: %s", file_path)
         except FileNotFoundError:
-            print(f"FILE FOR REMOVAL NOT FOUND: {file_path}")
+            logger.debug("FILE FOR REMOVAL NOT FOUND: %s", file_path)
 
 
-def upload_file_to_s3(output_path):
-    print("UPLOADING FILE TO S3")
-    s3_client = boto3.client('s3')
-
-    print("CONNECTED TO THE S3 CLIENT")
+async def upload_file_to_s3(output_path: str) -> str:
+    """
+    Uploads the FaceFusion output with the shared S3 uploader and removes the local file.
 
-    print("UPLOADING FILEOBJ TO S3")
-    # Open the file in binary mode
-    with open(output_path, 'rb') as data:
-        # Upload the file to S3
-        s3_client.upload_fileobj(data, 'magicalcurie', output_path)
+    Args:
+        output_path (str): Path of the output file.
 
-    # Construct the S3 URI
-    s3_uri = f"{os.getenvb('S3_URI')}/{output_path}"
+    Returns:
+        str: The S3 URI of the uploaded file.
+    """
+    logger.info("UPLOADING FILE TO S3")
+    key = os.path.basename(output_path)
+    content_type, _ = mimetypes.guess_type(output_path)
 
-    print("REMOVING THE LOCAL FILE")
-    # Remove the local file
-    os.remove(output_path)
+    try:
+        stats = await s3_uploader.uploader.upload_file(output_path, key, content_type)
+        logger.info("UPLOADED OUTPUT AT %s MB/S", stats.mb_per_second)
+    finally:
+        # Remove the local file, also when the upload failed or was cancelled
+        os.remove(output_path)
 
-    return s3_uri
+    return s3_uploader.uploader.uri(key)
 
 
 async def send_webhook_acknowledgment(
         user_id: str, 
         message_id: str, 
         status: str, 
-        s3_uri: str = None) -> None:
+        s3_uri: str = None,
+        timings: Optional[Dict[str, float]] = None,
+        progress: Optional[dict] = None) -> None:
     """
-    Sends an acknowledgment message via webhook.
+    Sends an acknowledgment message via webhook. The message is queued on the
+    webhook outbox, which delivers and retries it in the background.
 
     Args:
         user_id (str): The unique identifier for the user.
@@ -126,15 +120,16 @@ async def send_webhook_acknowledgment(
         status (str): The status of the message.
         webhook_url (str): The URL of the webhook endpoint.
         s3_uri (str): The S3 URI associated with the message.
+        timings (Optional[Dict[str, float]]): Per-stage timings of the job, sent when WEBHOOK_INCLUDE_TIMINGS is set.
+        progress (Optional[dict]): The latest progress of a running job.
 
     Returns:
         None
     """
     webhook_url = f"{os.getenv('FACEFUSION_BACKEND_URL')}/deepfake/facefusion-webhook"
     
-    print("SENDING WEBHOOK ACKNOWLEDGMENT")
+    logger.debug("SENDING WEBHOOK ACKNOWLEDGMENT")
     try:
-        print("CREATING DICTIONARY TO STORE THE FIELDS")
         # Create a dictionary to store the fields
         message_fields = {
             'user_id': user_id,
@@ -143,19 +138,18 @@ async def send_webhook_acknowledgment(
         }
 
         if s3_uri is not None:
-            print("ADDING S3_URI FIELD TO MESSAGE MODEL")
             message_fields['s3_uri'] = s3_uri
 
-        print("CREATING MESSAGE MODEL")
+        if timings is not None and os.getenv('WEBHOOK_INCLUDE_TIMINGS'):
+            message_fields['timings'] = timings
+
+        if progress is not None:
+            message_fields['progress'] = progress
+
         # Create the Message object
         message = Message(**message_fields)
 
-        print(f"MAKING POST REQUEST TO THE WEBHHOK {webhook_url}")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(webhook_url, json=message.__dict__)
-            if response.status_code == 200:
-                print("Webhook request successful!")
-            else:
-                print(f"Webhook request failed with status code {response.status_code}")
+        logger.info("QUEUEING %s WEBHOOK TO %s", status, webhook_url)
+        webhooks.outbox.send(webhook_url, str(message_id), message.__dict__)
     except Exception as e:
-        print(f"Error sending acknowledgment: {str(e)}")
\ No newline at end of file
+        logger.exception("ERROR SENDING ACKNOWLEDGMENT: %s", e)
\ No newline at end of file
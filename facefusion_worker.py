@@ -0,0 +1,120 @@
+"""
+Persistent FaceFusion worker.
+
+Runs with the python of the facefusion conda env, from the FaceFusion directory,
+and keeps FaceFusion and its models loaded between jobs. Jobs arrive as JSON
+lines on stdin and every reply is a JSON line on stdout:
+
+    {"type": "run", "args": [...]}  ->  {"type": "done"} or {"type": "error", "error": "..."}
+    {"type": "ping"}                ->  {"type": "pong"}
+
+A {"type": "ready"} line is sent once the models are loaded. Everything
+FaceFusion itself prints goes to stderr.
+
+With --stub the worker doesn't load FaceFusion and just copies the target to
+the output after --stub-delay seconds, which is enough to exercise the pool.
+"""
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+
+from typing import List
+
+def get_arg(args: List[str], name: str) -> str:
+    return args[args.index(name) + 1]
+
+class StubRunner:
+    def __init__(self, delay: float, frames: int = 10) -> None:
+        self.delay = delay
+        self.frames = frames
+
+    def run(self, args: List[str]) -> None:
+        # Report progress the way FaceFusion's tqdm bar does
+        for frame in range(1, self.frames + 1):
+            time.sleep(self.delay / self.frames)
+            sys.stderr.write(f"\rProcessing: {frame}/{self.frames} [00:00<00:00]")
+            sys.stderr.flush()
+        sys.stderr.write("\n")
+        shutil.copyfile(get_arg(args, '--target'), get_arg(args, '--output'))
+
+class FaceFusionRunner:
+    def __init__(self, base_args: List[str]) -> None:
+        sys.path.insert(0, os.getcwd())
+
+        from facefusion import core
+
+        self.core = core
+
+        # Let FaceFusion build its own argument parser, without running anything
+        captured = {}
+        core.run = lambda program: captured.setdefault('program', program)
+        sys.argv = ['run.py', '--headless'] + base_args
+        core.cli()
+        self.program = captured['program']
+
+        self.apply(base_args)
+        self.preload()
+
+    def apply(self, args: List[str]) -> None:
+        # apply_args reads sys.argv through the parser
+        sys.argv = ['run.py', '--headless'] + args
+        self.core.apply_args(self.program)
+
+    def preload(self) -> None:
+        from facefusion import face_analyser
+        from facefusion.processors.frame.core import get_frame_processors_modules
+        import facefusion.globals
+
+        face_analyser.get_face_analyser()
+        for frame_processor_module in get_frame_processors_modules(facefusion.globals.frame_processors):
+            if not frame_processor_module.pre_check():
+                raise RuntimeError(f"PRE CHECK FAILED FOR {frame_processor_module.__name__}")
+            frame_processor_module.get_frame_processor()
+
+    def run(self, args: List[str]) -> None:
+        from facefusion import face_store
+
+        # The reference face is only picked while none is stored, and the
+        # static faces would pile up across jobs
+        face_store.clear_reference_faces()
+        face_store.clear_static_faces()
+        self.apply(args)
+        self.core.conditional_process()
+
+        if not os.path.exists(get_arg(args, '--output')):
+            raise RuntimeError("FACEFUSION PRODUCED NO OUTPUT")
+
+def main() -> None:
+    # Keep stdout for the protocol and send everything else to stderr
+    protocol = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    def send(message: dict) -> None:
+        protocol.write(json.dumps(message) + '\n')
+        protocol.flush()
+
+    argv = sys.argv[1:]
+    if '--stub' in argv:
+        runner = StubRunner(float(get_arg(argv, '--stub-delay')) if '--stub-delay' in argv else 0.0)
+    else:
+        runner = FaceFusionRunner(argv)
+
+    send({'type': 'ready'})
+
+    for line in sys.stdin:
+        message = json.loads(line)
+        if message['type'] == 'ping':
+            send({'type': 'pong'})
+        elif message['type'] == 'run':
+            try:
+                runner.run(message['args'])
+                send({'type': 'done'})
+            except Exception as e:
+                traceback.print_exc()
+                send({'type': 'error', 'error': str(e)})
+
+if __name__ == '__main__':
+    main()
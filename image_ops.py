@@ -0,0 +1,141 @@
+"""
+Image operations run in the preprocessing process pool.
+
+Only depends on OpenCV and NumPy, so the spawned workers don't import the
+application.
+"""
+import struct
+
+from typing import Optional
+
+import cv2
+import numpy as np
+
+ENCODINGS = {
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+    'png': ('.png', None),
+}
+
+def _format_of(data: bytes) -> Optional[str]:
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def _exif_block(data: bytes, source_format: Optional[str]) -> Optional[bytes]:
+    # The EXIF chunk of a PNG (eXIf) or WebP (EXIF) image
+    if source_format == 'png':
+        offset, header = 8, 8
+    elif source_format == 'webp':
+        offset, header = 12, 8
+    else:
+        return None
+
+    while offset + header <= len(data):
+        if source_format == 'png':
+            length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+            padded = length + 4
+        else:
+            kind, length = struct.unpack('<4sI', data[offset:offset + 8])
+            padded = length + (length & 1)
+        if kind in (b'eXIf', b'EXIF'):
+            block = data[offset + header:offset + header + length]
+            return block[6:] if block.startswith(b'Exif\x00\x00') else block
+        if kind in (b'IDAT', b'IEND'):
+            return None
+        offset += header + padded
+    return None
+
+def _exif_orientation(data: bytes, source_format: Optional[str]) -> int:
+    """
+    Returns the EXIF orientation (1-8) of a PNG or WebP image, 1 if it has none.
+    """
+    block = _exif_block(data, source_format)
+    if not block or block[:2] not in (b'II', b'MM'):
+        return 1
+
+    order = '<' if block[:2] == b'II' else '>'
+    try:
+        ifd = struct.unpack(order + 'I', block[4:8])[0]
+        count = struct.unpack(order + 'H', block[ifd:ifd + 2])[0]
+        for index in range(count):
+            entry = ifd + 2 + index * 12
+            tag, _, _, value = struct.unpack(order + 'HHI4s', block[entry:entry + 12])
+            if tag == 0x0112:
+                # A SHORT sits in the first two bytes of the value field
+                orientation = struct.unpack(order + 'H', value[:2])[0]
+                return orientation if 1 <= orientation <= 8 else 1
+    except struct.error:
+        pass
+    return 1
+
+def _orient(image: np.ndarray, orientation: int) -> np.ndarray:
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+def init_worker() -> None:
+    # The pool already runs one image per process
+    cv2.setNumThreads(1)
+
+def preprocess_image(data: bytes, max_side: int, image_format: str, quality: int) -> Optional[bytes]:
+    """
+    Decodes an image, applying its EXIF orientation, scales it down so its
+    longest side is at most `max_side` and encodes it as `image_format`.
+    Images with an alpha channel are kept as PNG.
+
+    Returns:
+        Optional[bytes]: The encoded image, or None if it is already within the
+        cap and in the requested format.
+    """
+    source_format = _format_of(data)
+    buffer = np.frombuffer(data, np.uint8)
+
+    image = None
+    if source_format in ('png', 'webp'):
+        # Keep the alpha channel, LoadImage turns it into a mask
+        image = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+        if image is not None and image.ndim == 3 and image.shape[2] == 4:
+            image_format = 'png'
+            # IMREAD_UNCHANGED ignores the EXIF orientation
+            image = _orient(image, _exif_orientation(data, source_format))
+        else:
+            image = None
+    if image is None:
+        # IMREAD_COLOR applies the EXIF orientation
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("COULDN'T DECODE THE IMAGE")
+
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1 and source_format == image_format:
+        return None
+
+    if scale < 1:
+        size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        # INTER_AREA averages the source pixels, the right filter for downscaling
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    extension, quality_flag = ENCODINGS[image_format]
+    params = [quality_flag, quality] if quality_flag is not None else []
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f"COULDN'T ENCODE THE IMAGE AS {image_format}")
+    return encoded.tobytes()
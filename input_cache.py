@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+from collections import OrderedDict
+
+import downloads
+import jobs
+import log
+import metrics
+
+from typing import Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Hard links don't work across filesystems
+        shutil.copyfile(src, dst)
+
+class CacheEntry:
+    def __init__(self, digest: str, path: str, size: int) -> None:
+        self.digest = digest
+        self.path = path
+        self.size = size
+        self.refcount = 0
+        self.last_used = time.time()
+
+class InputCache:
+    """
+    Local cache for downloaded job inputs.
+
+    Files are stored once under their SHA-256 and looked up by URI, so the
+    same source face or reference image is downloaded once and then hard linked
+    into every job that uses it. Entries in use by a job are pinned by a
+    refcount; unpinned entries are evicted least recently used first whenever
+    the cache grows over its disk budget.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.uris: Dict[str, str] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # The URI index doesn't survive a restart, but the content does
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('tmp-'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                self._add(CacheEntry(name, path, os.path.getsize(path)))
+
+    def _add(self, entry: CacheEntry) -> None:
+        self.entries[entry.digest] = entry
+        self.total_bytes += entry.size
+
+    def _evict(self) -> None:
+        for digest in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                return
+            entry = self.entries[digest]
+            if entry.refcount > 0:
+                continue
+
+            logger.info("EVICTING CACHED INPUT %s", digest)
+            del self.entries[digest]
+            self.total_bytes -= entry.size
+            self.uris = {uri: d for uri, d in self.uris.items() if d != digest}
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _pin(self, digest: str) -> CacheEntry:
+        entry = self.entries[digest]
+        entry.refcount += 1
+        entry.last_used = time.time()
+        self.entries.move_to_end(digest)
+        return entry
+
+    async def _fetch(self, uri: str) -> str:
+        tmp_path = os.path.join(self.cache_dir, f"tmp-{uuid.uuid4()}")
+        await downloads.downloader.download(uri, tmp_path)
+        digest = await jobs.engine.run_blocking(hash_file, tmp_path)
+
+        if digest in self.entries:
+            # Same content under another URI
+            os.remove(tmp_path)
+        else:
+            path = os.path.join(self.cache_dir, digest)
+            os.replace(tmp_path, path)
+            self._add(CacheEntry(digest, path, os.path.getsize(path)))
+
+        self.uris[uri] = digest
+        return digest
+
+    async def acquire(self, uri: str) -> CacheEntry:
+        """
+        Returns the pinned cache entry for a URI, downloading it on a miss.
+        Concurrent requests for the same URI share one download.
+        """
+        self._load()
+
+        digest = self.uris.get(uri)
+        if digest in self.entries and os.path.exists(self.entries[digest].path):
+            logger.debug("INPUT CACHE HIT FOR %s", uri)
+            metrics.INPUT_CACHE_REQUESTS.inc(result='hit')
+            return self._pin(digest)
+
+        while True:
+            if uri not in self._inflight:
+                logger.debug("INPUT CACHE MISS FOR %s", uri)
+                metrics.INPUT_CACHE_REQUESTS.inc(result='miss')
+                self._inflight[uri] = asyncio.ensure_future(self._fetch(uri))
+                self._inflight[uri].add_done_callback(lambda _: self._inflight.pop(uri, None))
+
+            digest = await asyncio.shield(self._inflight[uri])
+            # Another job's release may have evicted the fresh, still unpinned
+            # entry before this one resumed; there is no await between the
+            # check and the pin
+            if digest in self.entries:
+                entry = self._pin(digest)
+                self._evict()
+                return entry
+
+    def release(self, digests: List[Optional[str]]) -> None:
+        """
+        Unpins entries once the job using them is done.
+        """
+        for digest in digests:
+            entry = self.entries.get(digest)
+            if entry is not None and entry.refcount > 0:
+                entry.refcount -= 1
+        self._evict()
+
+    async def link(self, uri: str, path: str) -> Optional[str]:
+        """
+        Places the file behind a URI at the given path, through the cache when enabled.
+
+        Args:
+            uri (str): The URI of the file.
+            path (str): Where the job expects the file.
+
+        Returns:
+            Optional[str]: The digest of the pinned entry, to be released by the job,
+            or None if the cache is disabled.
+        """
+        if not self.enabled:
+            await downloads.downloader.download(uri, path)
+            return None
+
+        entry = await self.acquire(uri)
+        try:
+            await jobs.engine.run_blocking(_link_or_copy, entry.path, path)
+        except BaseException:
+            self.release([entry.digest])
+            raise
+        return entry.digest
+
+    async def link_all(self, files: List[tuple]) -> List[Optional[str]]:
+        """
+        Links several (uri, path) pairs concurrently. If any of them fails, the
+        entries pinned by the others are released before the error is raised.
+        """
+        tasks = [asyncio.ensure_future(self.link(uri, path)) for uri, path in files]
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            # gather cancels the links still running; release the ones that
+            # already pinned their entry, the caller never sees their digests
+            await asyncio.wait(tasks)
+            self.release([task.result() for task in tasks
+                          if not task.cancelled() and task.exception() is None])
+            raise
+
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            self.release([r for r in results if not isinstance(r, BaseException)])
+            raise errors[0]
+
+        return results
+
+
+cache = InputCache(
+    cache_dir=os.getenv('INPUT_CACHE_DIR', '/workspace/cache/inputs'),
+    max_bytes=int(os.getenv('INPUT_CACHE_MAX_BYTES', str(10 * 1024 ** 3))))
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+
+import jobs
+import progress
+
+def get_route_job(route: str, job_id: str) -> jobs.Job:
+    """
+    Returns a job of `route`, so a router never serves another route's jobs.
+
+    Raises:
+        HTTPException: 404 if there is no such job on the route.
+    """
+    job = jobs.engine.get(job_id)
+    if job is None or job.route != route:
+        raise HTTPException(status_code=404, detail="JOB NOT FOUND")
+    return job
+
+def add_job_routes(router: APIRouter, route: str) -> None:
+    """
+    Adds the status, cancel and events endpoints of the jobs of `route` to its
+    router. Add them last, `/{job_id}` would shadow the router's later GETs.
+    """
+    @router.get("/{job_id}")
+    async def get_job(job_id: str):
+        return get_route_job(route, job_id)
+
+    @router.post("/{job_id}/cancel")
+    async def cancel_job(job_id: str):
+        job = get_route_job(route, job_id)
+        if job.status in progress.FINISHED:
+            raise HTTPException(status_code=409, detail=f"JOB IS ALREADY {job.status.upper()}")
+
+        await jobs.engine.cancel(job_id)
+        return {'job_id': job.job_id, 'status': job.status}
+
+    @router.get("/{job_id}/events")
+    async def get_job_events(job_id: str):
+        job = get_route_job(route, job_id)
+        return StreamingResponse(progress.broker.stream(job), media_type="text/event-stream")
@@ -0,0 +1,265 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+import uuid
+
+import log
+import metrics
+import progress
+import scheduler
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = log.get_logger(__name__)
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class Job(BaseModel):
+    job_id: str
+    route: str
+    # 'queued', 'running', 'completed', 'failed' or 'cancelled'
+    status: str = 'queued'
+    created_at: str = Field(default_factory=_now)
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    error: Optional[str] = None
+    result: Optional[Any] = None
+    # Seconds spent in every stage of the job
+    timings: Dict[str, float] = {}
+    # Latest progress event of the job
+    progress: Optional[dict] = None
+    user_id: Optional[str] = None
+    priority: str = 'normal'
+    # Number of jobs that will start before this one, while it is queued
+    queue_position: Optional[int] = None
+
+class IdempotencyTable:
+    """
+    Remembers which job a submission key started, so a retried submission gets
+    the same job back instead of starting a second one. Keys expire after
+    `ttl` seconds and only the `max_keys` newest are kept.
+    """
+
+    def __init__(self, max_keys: int, ttl: float) -> None:
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[float, Job]]" = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Job]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() > entry[0]:
+            del self.entries[key]
+            return None
+        return entry[1]
+
+    def put(self, key: Tuple[str, str], job: Job) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, job)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+
+class JobEngine:
+    """
+    In-process job engine for the generation routes.
+
+    Jobs are accepted immediately and run as background tasks on the event loop.
+    The scheduler decides when a queued job of a route may start and refuses new
+    jobs with a 429 once the route is saturated. All blocking work (HTTP,
+    websocket, subprocess, S3) is handed to a bounded thread pool through
+    `run_blocking` so a running job never stalls the loop.
+    """
+
+    def __init__(self,
+                 max_workers: int,
+                 scheduler: scheduler.Scheduler,
+                 history_size: int = 1000,
+                 idempotency: Optional[IdempotencyTable] = None) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='job-worker')
+        self.scheduler = scheduler
+        self.history_size = history_size
+        self.idempotency = idempotency or IdempotencyTable(max_keys=10000, ttl=24 * 3600)
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+        metrics.JOBS_IN_FLIGHT.set_function(self.in_flight)
+
+    def _remember(self, job: Job) -> None:
+        self.jobs[job.job_id] = job
+        # Forget the oldest finished jobs once the history is full
+        while len(self.jobs) > self.history_size:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status in ('queued', 'running'):
+                break
+            del self.jobs[oldest_id]
+
+    def in_flight(self) -> Dict[Tuple[str, str], int]:
+        counts = {}
+        for job in self.jobs.values():
+            if job.status in ('queued', 'running'):
+                counts[(job.route, job.status)] = counts.get((job.route, job.status), 0) + 1
+        return counts
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.queue_position = self.scheduler[job.route].position(job) if job.status == 'queued' else None
+        return job
+
+    def submit(self,
+               route: str,
+               handler: Callable[..., Any],
+               *args,
+               user_id: Optional[str] = None,
+               priority: str = 'normal',
+               idempotency_key: Optional[str] = None) -> Job:
+        """
+        Registers a job and schedules `handler(job, *args)` in the background.
+
+        If a job was already submitted to the route with the same
+        `idempotency_key` (e.g. the caller's message id) and didn't fail, that
+        job is returned instead, whether it is still in flight or finished.
+
+        Args:
+            route (str): The route the job belongs to, used for scheduling.
+            handler (Callable): Coroutine function doing the work of the job.
+            user_id (Optional[str]): The user the job is shared fairly for.
+            priority (str): 'high', 'normal' or 'low'.
+            idempotency_key (Optional[str]): Identifies retries of the same submission.
+
+        Raises:
+            scheduler.Saturated: If the route can't take more queued jobs.
+
+        Returns:
+            Job: The registered job, still in the 'queued' state.
+        """
+        if idempotency_key:
+            existing = self.idempotency.get((route, idempotency_key))
+            # A failed or cancelled job may be retried for real
+            if existing is not None and existing.status not in ('failed', 'cancelled'):
+                logger.info("DUPLICATE SUBMISSION %s ATTACHED TO JOB %s", idempotency_key, existing.job_id)
+                metrics.DUPLICATE_SUBMISSIONS.inc(route=route)
+                return existing
+
+        if priority not in scheduler.PRIORITIES:
+            priority = 'normal'
+        route_scheduler = self.scheduler[route]
+        job = Job(job_id=str(uuid.uuid4()), route=route, user_id=str(user_id), priority=priority)
+        ticket = route_scheduler.enqueue(job, job.user_id, priority)
+
+        self._remember(job)
+        if idempotency_key:
+            self.idempotency.put((route, idempotency_key), job)
+
+        task = asyncio.create_task(self._run(job, ticket, handler, *args))
+        self._tasks[job.job_id] = task
+
+        def on_done(_):
+            self._tasks.pop(job.job_id, None)
+            # A task cancelled before it ever ran still holds its ticket
+            route_scheduler.abandon(ticket)
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                self._finish(job)
+
+        task.add_done_callback(on_done)
+
+        return job
+
+    async def cancel(self, job_id: str, wait: float = 5.0) -> Optional[Job]:
+        """
+        Cancels a queued or running job. The job's task is cancelled, so the
+        handler unwinds from wherever it waits and releases what it holds
+        (ComfyUI prompt, FaceFusion process, transfers, scratch files).
+
+        Args:
+            job_id (str): The job to cancel.
+            wait (float): Seconds to wait for the job to finish unwinding.
+
+        Returns:
+            Optional[Job]: The job, or None if it is unknown.
+        """
+        job = self.jobs.get(job_id)
+        task = self._tasks.get(job_id)
+        if job is None or task is None:
+            return job
+
+        logger.info("CANCELLING JOB %s", job_id)
+        task.cancel()
+        await asyncio.wait({task}, timeout=wait)
+        return job
+
+    def _finish(self, job: Job) -> None:
+        job.finished_at = _now()
+        metrics.JOBS_TOTAL.inc(route=job.route, status=job.status)
+        progress.broker.publish_status(job)
+
+    async def _run(self, job: Job, ticket: scheduler.Ticket, handler: Callable[..., Any], *args) -> None:
+        log.job_id.set(job.job_id)
+        route_scheduler = self.scheduler[job.route]
+        try:
+            await route_scheduler.acquire(ticket)
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            self._finish(job)
+            raise
+
+        started = time.monotonic()
+        job.status = 'running'
+        job.started_at = _now()
+        progress.broker.publish_status(job)
+        try:
+            job.result = await handler(job, *args)
+            job.status = 'completed'
+        except asyncio.CancelledError:
+            logger.info("JOB %s CANCELLED", job.job_id)
+            job.status = 'cancelled'
+            raise
+        except Exception as e:
+            logger.error("JOB %s FAILED: %s", job.job_id, e)
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            route_scheduler.release(ticket, time.monotonic() - started)
+            self._finish(job)
+
+    async def run_blocking(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs a blocking callable on the worker pool and awaits its result.
+        The caller's context (e.g. the logging context) goes along with it.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+def _route_scheduler(route: str, max_running: str) -> scheduler.RouteScheduler:
+    prefix = route.upper()
+    return scheduler.RouteScheduler(
+        route,
+        max_running=int(os.getenv(f'{prefix}_MAX_CONCURRENCY', max_running)),
+        max_queued=int(os.getenv(f'{prefix}_MAX_QUEUED', '100')),
+        max_queued_per_user=int(os.getenv(f'{prefix}_MAX_QUEUED_PER_USER', '10')))
+
+
+engine = JobEngine(
+    max_workers=int(os.getenv('JOB_WORKER_THREADS', '16')),
+    scheduler=scheduler.Scheduler({
+        'comfyui': _route_scheduler('comfyui', '4'),
+        'facefusion': _route_scheduler('facefusion', '1'),
+    }),
+    history_size=int(os.getenv('JOB_HISTORY_SIZE', '1000')),
+    idempotency=IdempotencyTable(
+        max_keys=int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000')),
+        ttl=float(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))))
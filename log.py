@@ -0,0 +1,94 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+from typing import Any, Iterator, Optional
+
+# Context of the job being worked on, attached to every log record
+job_id: contextvars.ContextVar = contextvars.ContextVar('job_id', default='-')
+user_id: contextvars.ContextVar = contextvars.ContextVar('user_id', default='-')
+prompt_id: contextvars.ContextVar = contextvars.ContextVar('prompt_id', default='-')
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+class Truncated:
+    """
+    Wraps a payload for logging. It is only turned into a string, and cut to
+    `limit` characters, if the record is actually emitted.
+    """
+
+    def __init__(self, value: Any, limit: Optional[int] = None) -> None:
+        self.value = value
+        self.limit = limit or int(os.getenv('LOG_PAYLOAD_LIMIT', '500'))
+
+    def __str__(self) -> str:
+        text = str(self.value)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text)} CHARS)"
+        return text
+
+def truncate(value: Any, limit: Optional[int] = None) -> Truncated:
+    return Truncated(value, limit)
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = job_id.get()
+        record.user_id = user_id.get()
+        record.prompt_id = prompt_id.get()
+        return True
+
+@contextlib.contextmanager
+def context(**fields) -> Iterator[None]:
+    """
+    Sets job_id, user_id and/or prompt_id for every record logged inside the block.
+    """
+    variables = {'job_id': job_id, 'user_id': user_id, 'prompt_id': prompt_id}
+    tokens = [(variables[name], variables[name].set(str(value))) for name, value in fields.items()]
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+def create_background_task(coro) -> asyncio.Task:
+    """
+    Creates a long-lived task that doesn't inherit the job context of whoever
+    happened to start it.
+    """
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+def configure() -> None:
+    """
+    Sends all application logging through a queue to a background thread that
+    writes to stdout, so logging never blocks a request on stdout. The level
+    comes from LOG_LEVEL.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s [job=%(job_id)s user=%(user_id)s prompt=%(prompt_id)s] %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # The context has to be captured in the thread that logs, not in the listener
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
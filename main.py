@@ -1,14 +1,11 @@
 from dotenv import load_dotenv
 
+import asyncio
+import contextlib
 import os
 
-import boto3
-
 from fastapi import FastAPI
-import uvicorn
-
-import comfyui
-import facefusion
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 # Determine the environment (default to production)
 env = os.getenv('ENV', 'production')
@@ -24,18 +21,94 @@ else:
 # Load the .env file
 load_dotenv(env_file)
 
-# Load AWS S3 Access keys from environment variables
-S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY')
-S3_SECRET_ACCESS_KEY = os.getenv('S3_SECRET_ACCESS_KEY')
+import log
+
+log.configure()
+
+logger = log.get_logger(__name__)
+
+# The routers read their limits from the environment on import
+import comfyui
+import downloads
+import facefusion
+import jobs
+import metrics
+import preprocessing
+import s3_uploader
+import webhooks
+
+# 'warm' connects to every backend and starts the FaceFusion workers in the
+# background at startup, 'lazy' waits for the first job that needs them
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'warm')
+# Backends that must be up for /ready to succeed
+READY_CHECKS = [check.strip() for check in os.getenv('READY_CHECKS', 'comfyui,facefusion,s3').split(',') if check.strip()]
+# Comma separated URLs to open pooled connections to at startup, e.g. the CDN inputs come from
+PRECONNECT_URLS = [url.strip() for url in os.getenv('PRECONNECT_URLS', '').split(',') if url.strip()]
 
-boto3.setup_default_session(aws_access_key_id=S3_ACCESS_KEY,
-                            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-                            region_name='us-east-1')
+async def preconnect(url):
+    try:
+        await downloads.downloader.client.head(url)
+    except Exception as e:
+        logger.warning("COULDN'T PRECONNECT TO %s: %s", url, e)
 
-app = FastAPI()
+async def warm_s3(interval=5.0):
+    # Keep trying, so /ready recovers once the bucket is reachable
+    while True:
+        await jobs.engine.run_blocking(s3_uploader.uploader.warm)
+        if s3_uploader.uploader.reachable:
+            return
+        await asyncio.sleep(interval)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    webhooks.outbox.start()
+
+    warmup = []
+    if STARTUP_MODE == 'warm':
+        # Nothing here is awaited, so the server takes requests (and answers
+        # /ready) while the backends come up
+        comfyui.pool.start()
+        warmup.append(log.create_background_task(facefusion.workers.start()))
+        warmup.append(log.create_background_task(warm_s3()))
+        warmup.extend(log.create_background_task(preconnect(url)) for url in PRECONNECT_URLS)
+        if preprocessing.preprocessor.max_side > 0:
+            warmup.append(log.create_background_task(preprocessing.preprocessor.warm()))
+
+    yield
+
+    for task in warmup:
+        task.cancel()
+    await comfyui.pool.stop()
+    await facefusion.workers.stop()
+    await webhooks.outbox.stop()
+    preprocessing.preprocessor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(comfyui.router)
 app.include_router(facefusion.router)
 
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def get_ready():
+    """
+    Readiness probe: 200 once every backend in READY_CHECKS is up, 503 until then.
+    """
+    checks = {'comfyui': comfyui.pool.ready,
+              'facefusion': facefusion.workers.ready,
+              's3': s3_uploader.uploader.reachable}
+    ready = all(checks[check] for check in READY_CHECKS if check in checks)
+
+    return JSONResponse({'ready': ready,
+                         'checks': checks,
+                         'comfyui': comfyui.pool.status(),
+                         'facefusion': facefusion.workers.status()},
+                        status_code=200 if ready else 503)
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=8000)
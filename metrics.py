@@ -0,0 +1,167 @@
+import contextlib
+import threading
+import time
+
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return '\n'.join(lines + self.samples())
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                    for key, value in self._values.items()]
+
+class Gauge(Metric):
+    """
+    Gauge that is either set directly or read from a callback at scrape time.
+    The callback returns a mapping from label values to the current value.
+    """
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            values = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                for key, value in values.items() if value is not None]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # Per label set: bucket counts, sum, count
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+                for bound, bucket_count in zip(bounds, counts + [count]):
+                    labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+
+JOB_STAGE_SECONDS = registry.register(Histogram(
+    'job_stage_seconds', 'Duration of the stages of a job.', ['route', 'stage']))
+JOBS_TOTAL = registry.register(Counter(
+    'jobs_total', 'Finished jobs by outcome.', ['route', 'status']))
+DUPLICATE_SUBMISSIONS = registry.register(Counter(
+    'duplicate_submissions_total', 'Retried submissions attached to an existing job.', ['route']))
+JOBS_IN_FLIGHT = registry.register(Gauge(
+    'jobs_in_flight', 'Jobs that are queued or running.', ['route', 'status']))
+DOWNLOAD_BYTES = registry.register(Counter(
+    'download_bytes_total', 'Bytes of job inputs downloaded.'))
+UPLOAD_BYTES = registry.register(Counter(
+    'upload_bytes_total', 'Bytes of job outputs uploaded to S3.'))
+INPUT_CACHE_REQUESTS = registry.register(Counter(
+    'input_cache_requests_total', 'Input cache lookups by result.', ['result']))
+RESULT_CACHE_REQUESTS = registry.register(Counter(
+    'result_cache_requests_total', 'Result cache lookups by result.', ['result']))
+WEBHOOK_SECONDS = registry.register(Histogram(
+    'webhook_delivery_seconds', 'Duration of webhook deliveries.', ['outcome']))
+COMFYUI_QUEUE_DEPTH = registry.register(Gauge(
+    'comfyui_queue_depth', 'Prompts remaining in the queue of every ComfyUI backend.', ['backend']))
+COMFYUI_BACKEND_UP = registry.register(Gauge(
+    'comfyui_backend_up', 'Whether a ComfyUI backend is healthy (1) or ejected (0).', ['backend']))
+
+@contextlib.contextmanager
+def timed(job, stage: str) -> Iterator[None]:
+    """
+    Times a stage of a job, recording it in the stage histogram and in the
+    job's own timing breakdown.
+
+    Args:
+        job (Job): The job the stage belongs to.
+        stage (str): Name of the stage, e.g. 'download' or 'upload'.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(job, stage, time.perf_counter() - start)
+
+def record(job, stage: str, seconds: float) -> None:
+    JOB_STAGE_SECONDS.observe(seconds, route=job.route, stage=stage)
+    job.timings[stage] = round(job.timings.get(stage, 0) + seconds, 3)
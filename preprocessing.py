@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+
+import jobs
+import log
+
+from typing import Optional
+
+logger = log.get_logger(__name__)
+
+class Preprocessor:
+    """
+    Downscales and re-encodes input images before they are handed to ComfyUI
+    or FaceFusion, so they don't spend GPU memory and time on 20+ MP photos.
+
+    Images are decoded, turned upright according to their EXIF orientation,
+    capped to `max_side` pixels on their longest side and encoded as
+    `image_format` in a pool of processes, off the event loop and the GIL.
+    Results are cached on disk by the SHA-256 of the source and the settings,
+    so a reference image used by many jobs is processed once.
+
+    The files keep their names; ComfyUI and FaceFusion detect the format from
+    the content.
+    """
+
+    def __init__(self,
+                 max_side: int,
+                 image_format: str,
+                 quality: int,
+                 workers: int,
+                 cache_dir: str,
+                 cache_max_bytes: int) -> None:
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            import image_ops
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Forking would copy the event loop's threads and sockets
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=image_ops.init_worker)
+        return self._executor
+
+    async def warm(self) -> None:
+        """
+        Starts the worker processes ahead of the first job.
+        """
+        # Importing OpenCV takes a while, keep it off the event loop
+        executor = await jobs.engine.run_blocking(self._get_executor)
+        import image_ops
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, image_ops.init_worker) for _ in range(self.workers)])
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def cap(self, max_side=None) -> int:
+        """
+        Returns the resolution cap for a job, 0 if preprocessing is off.
+
+        Raises:
+            ValueError: If `max_side` isn't a non-negative integer.
+        """
+        if max_side is None:
+            return self.max_side
+        if isinstance(max_side, bool) or not isinstance(max_side, (int, str)):
+            raise ValueError(f"MAX_INPUT_SIDE MUST BE A NON-NEGATIVE INTEGER, GOT {max_side!r}")
+        try:
+            max_side = int(max_side)
+        except ValueError:
+            raise ValueError(f"MAX_INPUT_SIDE MUST BE A NON-NEGATIVE INTEGER, GOT {max_side!r}")
+        if max_side < 0:
+            raise ValueError(f"MAX_INPUT_SIDE MUST BE A NON-NEGATIVE INTEGER, GOT {max_side!r}")
+        return max_side
+
+    def _key(self, digest: str, max_side: int) -> str:
+        return hashlib.sha256(f"{digest}:{max_side}:{self.image_format}:{self.quality}".encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        path = os.path.join(self.cache_dir, key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _store(self, key: str, data: Optional[bytes]) -> str:
+        # An empty file records that the image needs no preprocessing
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = os.path.join(self.cache_dir, f"tmp-{uuid.uuid4()}")
+        with open(tmp_path, 'wb') as f:
+            f.write(data or b'')
+        os.replace(tmp_path, path)
+        self._evict()
+        return path
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('tmp-'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.cache_max_bytes:
+                return
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    async def _process(self, key: str, data: bytes, max_side: int) -> str:
+        import image_ops
+
+        loop = asyncio.get_running_loop()
+        try:
+            processed = await loop.run_in_executor(self._get_executor(), image_ops.preprocess_image,
+                                                   data, max_side, self.image_format, self.quality)
+        except ValueError as e:
+            # Not an image OpenCV can read; hand it over untouched
+            logger.warning("COULDN'T PREPROCESS INPUT IMAGE: %s", e)
+            processed = None
+        return await jobs.engine.run_blocking(self._store, key, processed)
+
+    async def _cached(self, key: str, read, max_side: int) -> str:
+        """
+        Returns the cached result for a key, processing the image on a miss.
+        Concurrent requests for the same key share one run.
+        """
+        path = await jobs.engine.run_blocking(self._lookup, key)
+        if path is not None:
+            logger.debug("PREPROCESSING CACHE HIT FOR %s", key)
+            return path
+
+        if key not in self._inflight:
+            async def run():
+                return await self._process(key, await read(), max_side)
+
+            self._inflight[key] = asyncio.ensure_future(run())
+            self._inflight[key].add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(self._inflight[key])
+
+    async def process(self, data: bytes, digest: str, max_side: int) -> tuple:
+        """
+        Preprocesses an image held in memory.
+
+        Returns:
+            tuple: The image to hand over and its digest; the original ones if
+            the image needed no preprocessing.
+        """
+        if max_side <= 0:
+            return data, digest
+
+        key = self._key(digest, max_side)
+
+        async def read():
+            return data
+
+        path = await self._cached(key, read, max_side)
+        processed = await jobs.engine.run_blocking(_read_file, path)
+        if not processed:
+            return data, digest
+
+        logger.debug("PREPROCESSED INPUT IMAGE %s FROM %s TO %s BYTES", digest, len(data), len(processed))
+        return processed, key
+
+    async def process_file(self, path: str, digest: str, max_side: int) -> str:
+        """
+        Preprocesses an image saved at `path` in place. The file is replaced
+        rather than rewritten, since it may be a hard link into the input cache.
+
+        Returns:
+            str: The digest of the file now at `path`.
+        """
+        if max_side <= 0:
+            return digest
+
+        key = self._key(digest, max_side)
+        cached = await self._cached(key, lambda: jobs.engine.run_blocking(_read_file, path), max_side)
+        if not await jobs.engine.run_blocking(os.path.getsize, cached):
+            return digest
+
+        await jobs.engine.run_blocking(_replace_with_copy, cached, path)
+        logger.debug("PREPROCESSED INPUT IMAGE %s", path)
+        return key
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _replace_with_copy(src: str, dst: str) -> None:
+    tmp_path = f"{dst}.tmp-{uuid.uuid4()}"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        # Hard links don't work across filesystems
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+preprocessor = Preprocessor(
+    # Longest side of input images in pixels, 0 leaves them untouched unless a workflow sets a cap
+    max_side=int(os.getenv('PREPROCESS_MAX_SIDE', '0')),
+    image_format=os.getenv('PREPROCESS_FORMAT', 'jpg'),
+    quality=int(os.getenv('PREPROCESS_QUALITY', '95')),
+    workers=int(os.getenv('PREPROCESS_WORKERS', str(min(os.cpu_count() or 1, 4)))),
+    cache_dir=os.getenv('PREPROCESS_CACHE_DIR', '/workspace/cache/preprocessed'),
+    cache_max_bytes=int(os.getenv('PREPROCESS_CACHE_MAX_BYTES', str(2 * 1024 ** 3))))
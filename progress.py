@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import time
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+FINISHED = ('completed', 'failed', 'cancelled')
+
+class ProgressBroker:
+    """
+    Fans out the progress events of jobs to their Server-Sent Events subscribers.
+    """
+
+    def __init__(self, queue_size: int = 100) -> None:
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(job_id, []).append(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(job_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            self._subscribers.pop(job_id, None)
+
+    def publish(self, job_id: str, event: dict) -> None:
+        for queue in self._subscribers.get(job_id, []):
+            if queue.full():
+                # A slow client only misses intermediate progress
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def publish_status(self, job) -> None:
+        self.publish(job.job_id, {'type': 'status', 'status': job.status})
+
+    async def stream(self, job, keepalive: float = 15.0):
+        """
+        Yields the job's events in SSE format until the job is finished.
+        """
+        queue = self.subscribe(job.job_id)
+        try:
+            yield _sse({'type': 'status', 'status': job.status})
+            if job.progress:
+                yield _sse(job.progress)
+
+            while job.status not in FINISHED:
+                try:
+                    event = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+
+                yield _sse(event)
+                if event['type'] == 'status' and event['status'] in FINISHED:
+                    break
+        finally:
+            self.unsubscribe(job.job_id, queue)
+
+def _sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+class ProgressTracker:
+    """
+    Records the progress of one job, publishes it to the job's SSE subscribers
+    and, at most once per `interval` seconds, passes it to `notify` (e.g. a
+    progress webhook).
+    """
+
+    def __init__(self,
+                 job,
+                 notify: Optional[Callable[[dict], Awaitable[None]]] = None,
+                 interval: float = 0.0,
+                 **fields) -> None:
+        self.job = job
+        self.notify = notify
+        self.interval = interval
+        # Added to every event, e.g. the index of a batch item
+        self.fields = fields
+        self._last_notified = 0.0
+
+    async def update(self, **event) -> None:
+        event.update(self.fields)
+        event['type'] = 'progress'
+        self.job.progress = event
+        broker.publish(self.job.job_id, event)
+
+        if self.notify is None or self.interval <= 0:
+            return
+
+        now = time.monotonic()
+        if now - self._last_notified >= self.interval:
+            self._last_notified = now
+            await self.notify(event)
+
+
+broker = ProgressBroker(queue_size=int(os.getenv('PROGRESS_QUEUE_SIZE', '100')))
+
+# Seconds between progress webhooks of a job, 0 disables them
+WEBHOOK_INTERVAL = float(os.getenv('PROGRESS_WEBHOOK_INTERVAL', '0'))
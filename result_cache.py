@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import input_cache
+import jobs
+import log
+import metrics
+
+from typing import Any, Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+class ResultCacheBackend:
+    """
+    Storage of a result cache. Implementations are blocking and called through
+    the job engine's thread pool.
+    """
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def put(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+class SQLiteBackend(ResultCacheBackend):
+    """
+    Keeps results in one SQLite table. Entries older than `ttl` seconds are
+    misses, and the least recently used entries are deleted once there are more
+    than `max_entries`.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: float) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                     "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                     "created_at REAL NOT NULL, last_used REAL NOT NULL)")
+        return self._connection
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock, self.connection as connection:
+            row = connection.execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._lock, self.connection as connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            connection.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+            connection.execute("DELETE FROM results WHERE key IN ("
+                               "SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+class FileBackend(ResultCacheBackend):
+    """
+    Keeps every result in its own JSON file, using the file's modification
+    time as its last use. Same TTL and LRU rules as the SQLite backend.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int, ttl: float) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if time.time() - entry['created_at'] > self.ttl:
+                os.remove(path)
+                return None
+            os.utime(path)
+            return entry['value']
+
+    def put(self, key: str, value: Any) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        with self._lock:
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump({'created_at': time.time(), 'value': value}, f)
+            os.replace(f"{path}.tmp", path)
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self.cache_dir, name)
+                entries.append((os.path.getmtime(path), path))
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            os.remove(path)
+
+def _canonical(value: Any, inputs: Dict[str, str]) -> Any:
+    # Input file names are random per request, so they're replaced by the hash of their content
+    if isinstance(value, dict):
+        return {k: _canonical(v, inputs) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_canonical(v, inputs) for v in value]
+    if isinstance(value, str) and value in inputs:
+        return f"input:{inputs[value]}"
+    return value
+
+class ResultCache:
+    """
+    Memoizes the S3 URIs of ComfyUI generations.
+
+    The key is a hash of the workflow graph, with the input image file names
+    replaced by the SHA-256 of their content, so the same workflow on the same
+    images maps to the same result however the request named its files. Only
+    deterministic workflows (fixed seeds) should be cached, so requests can opt
+    out with "cache": false.
+    """
+
+    def __init__(self, backend: Optional[ResultCacheBackend]) -> None:
+        self.backend = backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def key(self, workflow: dict, inputs: List[tuple]) -> str:
+        """
+        Args:
+            workflow (dict): The ComfyUI workflow.
+            inputs (List[tuple]): (file name, path, digest) of every input image. A
+                missing digest (input cache disabled) is computed from the file.
+        """
+        digests = {}
+        for filename, path, digest in inputs:
+            digests[filename] = digest or await jobs.engine.run_blocking(input_cache.hash_file, path)
+
+        canonical = json.dumps(_canonical(workflow, digests), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            value = await jobs.engine.run_blocking(self.backend.get, key)
+        except Exception as e:
+            logger.warning("RESULT CACHE LOOKUP FAILED: %s", e)
+            value = None
+
+        metrics.RESULT_CACHE_REQUESTS.inc(result='hit' if value is not None else 'miss')
+        return value
+
+    async def put(self, key: str, value: Any) -> None:
+        try:
+            await jobs.engine.run_blocking(self.backend.put, key, value)
+        except Exception as e:
+            logger.warning("COULDN'T STORE THE RESULT IN THE CACHE: %s", e)
+
+def create_backend() -> Optional[ResultCacheBackend]:
+    backend = os.getenv('RESULT_CACHE_BACKEND', '')
+    max_entries = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '10000'))
+    ttl = float(os.getenv('RESULT_CACHE_TTL', str(7 * 24 * 3600)))
+
+    if backend == 'sqlite':
+        return SQLiteBackend(os.getenv('RESULT_CACHE_PATH', '/workspace/cache/results.sqlite3'), max_entries, ttl)
+    if backend == 'file':
+        return FileBackend(os.getenv('RESULT_CACHE_PATH', '/workspace/cache/results'), max_entries, ttl)
+    if backend:
+        logger.warning("UNKNOWN RESULT CACHE BACKEND %s, THE RESULT CACHE IS DISABLED", backend)
+    return None
+
+
+cache = ResultCache(create_backend())
@@ -0,0 +1,183 @@
+import asyncio
+import contextvars
+import functools
+import io
+import os
+import threading
+import time
+
+import log
+import metrics
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel
+
+from typing import Optional
+
+logger = log.get_logger(__name__)
+
+class UploadStats(BaseModel):
+    key: str
+    bytes: int
+    seconds: float
+    mb_per_second: float
+
+class UploadCancelled(Exception):
+    pass
+
+class S3Uploader:
+    """
+    Shared S3 uploader.
+
+    Holds one thread-safe boto3 client for the whole process, uploads with a
+    tunable TransferConfig so large outputs go up as parallel multipart uploads,
+    and runs every transfer on its own executor so the event loop never blocks
+    on S3.
+
+    boto3 takes a while to import, so it is only imported once the client is
+    created, at startup in the background or on the first upload.
+    """
+
+    def __init__(self,
+                 bucket: str,
+                 multipart_threshold: int,
+                 multipart_chunksize: int,
+                 max_concurrency: int,
+                 max_workers: int = 8,
+                 endpoint_url: Optional[str] = None,
+                 access_key: Optional[str] = None,
+                 secret_key: Optional[str] = None,
+                 region_name: Optional[str] = None,
+                 base_uri: Optional[str] = None) -> None:
+        self.bucket = bucket
+        # Where uploaded objects are served from, the bucket's own URL by default
+        self.base_uri = (base_uri or f"https://{bucket}.s3.amazonaws.com").rstrip('/')
+        # Without credentials boto3 falls back to its default credential chain
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region_name = region_name
+        # Only set to talk to an S3-compatible stand-in, e.g. in benchmarks
+        self.endpoint_url = endpoint_url
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.max_workers = max_workers
+        self.transfer_config = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='s3-upload')
+        self._client = None
+        self._lock = threading.Lock()
+        # Whether the last `warm` reached the bucket
+        self.reachable = False
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self.connect()
+        return self._client
+
+    def connect(self) -> None:
+        """
+        Creates the boto3 client, on the first upload unless `warm` ran first.
+        """
+        import boto3
+
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.transfer_config = TransferConfig(multipart_threshold=self.multipart_threshold,
+                                              multipart_chunksize=self.multipart_chunksize,
+                                              max_concurrency=self.max_concurrency)
+
+        # Every multipart worker thread needs its own pooled connection
+        pool_size = self.transfer_config.max_request_concurrency + self.max_workers
+        if self.endpoint_url:
+            config = Config(max_pool_connections=pool_size, s3={'addressing_style': 'path'})
+        else:
+            config = Config(max_pool_connections=pool_size)
+
+        session = boto3.session.Session(aws_access_key_id=self.access_key,
+                                        aws_secret_access_key=self.secret_key,
+                                        region_name=self.region_name)
+        self._client = session.client('s3', endpoint_url=self.endpoint_url, config=config)
+
+    def warm(self) -> None:
+        """
+        Creates the client and opens a connection to the bucket, so the first
+        upload doesn't pay for the import, the TLS handshake or the endpoint
+        resolution.
+        """
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+            self.reachable = True
+        except Exception as e:
+            self.reachable = False
+            logger.warning("COULDN'T REACH S3 BUCKET %s: %s", self.bucket, e)
+
+    def uri(self, key: str) -> str:
+        """
+        Returns the URI an uploaded object is reachable at.
+        """
+        return f"{self.base_uri}/{key}"
+
+    def _upload(self, fileobj, key: str, size: int, content_type: Optional[str], cancelled: threading.Event) -> UploadStats:
+        extra_args = {'ContentType': content_type} if content_type else None
+
+        def check_cancelled(_):
+            # Raising from the progress callback fails the transfer, and a
+            # failed multipart upload is aborted
+            if cancelled.is_set():
+                raise UploadCancelled(f"UPLOAD OF {key} CANCELLED")
+
+        start = time.perf_counter()
+        self.client.upload_fileobj(fileobj, self.bucket, key,
+                                   ExtraArgs=extra_args,
+                                   Callback=check_cancelled,
+                                   Config=self.transfer_config)
+        seconds = time.perf_counter() - start
+        metrics.UPLOAD_BYTES.inc(size)
+
+        stats = UploadStats(key=key,
+                            bytes=size,
+                            seconds=round(seconds, 3),
+                            mb_per_second=round(size / 1024 ** 2 / seconds, 2) if seconds else 0.0)
+        logger.info("UPLOADED %s BYTES TO S3 KEY %s IN %sS (%s MB/S)", stats.bytes, key, stats.seconds, stats.mb_per_second)
+        return stats
+
+    def _upload_file(self, path: str, key: str, content_type: Optional[str], cancelled: threading.Event) -> UploadStats:
+        with open(path, 'rb') as data:
+            return self._upload(data, key, os.path.getsize(path), content_type, cancelled)
+
+    async def _run(self, fn, *args) -> UploadStats:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        cancelled = threading.Event()
+        try:
+            return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, cancelled))
+        except asyncio.CancelledError:
+            # The thread can't be interrupted, so stop the transfer at its next chunk
+            cancelled.set()
+            raise
+
+    async def upload_file(self, path: str, key: str, content_type: Optional[str] = None) -> UploadStats:
+        return await self._run(self._upload_file, path, key, content_type)
+
+    async def upload_bytes(self, data: bytes, key: str, content_type: Optional[str] = None) -> UploadStats:
+        # BytesIO shares the buffer of the bytes object, so the data isn't copied
+        return await self._run(self._upload, io.BytesIO(data), key, len(data), content_type)
+
+
+uploader = S3Uploader(
+    bucket=os.getenv('S3_BUCKET', 'magicalcurie'),
+    multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD', str(64 * 1024 ** 2))),
+    multipart_chunksize=int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(64 * 1024 ** 2))),
+    max_concurrency=int(os.getenv('S3_MAX_CONCURRENCY', '16')),
+    max_workers=int(os.getenv('S3_UPLOAD_WORKERS', '8')),
+    endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+    access_key=os.getenv('S3_ACCESS_KEY'),
+    secret_key=os.getenv('S3_SECRET_ACCESS_KEY'),
+    region_name=os.getenv('S3_REGION', 'us-east-1'),
+    base_uri=os.getenv('S3_URI'))
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+import math
+
+import log
+
+from collections import Counter
+from fastapi import HTTPException
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+class Saturated(HTTPException):
+    """
+    Answered as 429 Too Many Requests, with a Retry-After estimated from the
+    queue length and the recent job durations.
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(status_code=429, detail=message, headers={'Retry-After': str(retry_after)})
+        self.retry_after = retry_after
+
+class Ticket:
+    def __init__(self, job, user_id: str, lane: int, seq: int) -> None:
+        self.job = job
+        self.user_id = user_id
+        self.lane = lane
+        self.seq = seq
+        self.granted = asyncio.get_running_loop().create_future()
+        # Set once the ticket's slot has been given back
+        self.released = False
+
+class RouteScheduler:
+    """
+    Decides when the queued jobs of one route may start.
+
+    At most `max_running` jobs run at once. Waiting jobs start by priority
+    lane first; within a lane the user with the fewest running jobs goes
+    first, then the user whose last job started longest ago, and a user's own
+    jobs start in submission order, so one user can't starve the others. New
+    jobs are refused once too many are waiting overall or for their user.
+    With a depth probe, jobs also wait while the backend's own queue (e.g.
+    ComfyUI's /queue) is at `max_backend_depth`.
+    """
+
+    def __init__(self,
+                 route: str,
+                 max_running: int,
+                 max_queued: int,
+                 max_queued_per_user: int,
+                 depth_probe: Optional[Callable[[], Awaitable[int]]] = None,
+                 max_backend_depth: int = 0,
+                 probe_interval: float = 1.0) -> None:
+        self.route = route
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.depth_probe = depth_probe
+        self.max_backend_depth = max_backend_depth
+        self.probe_interval = probe_interval
+
+        self.waiting: List[Ticket] = []
+        self.running = 0
+        self.running_by_user: Counter = Counter()
+        # Dispatch number of the last job started for every user with queued or running jobs
+        self.last_started: Dict[str, int] = {}
+        self._dispatched = itertools.count()
+        self.backend_depth = 0
+        # Exponential moving average of job durations, for Retry-After
+        self.average_duration = 60.0
+        self._seq = itertools.count()
+        self._prober: Optional[asyncio.Task] = None
+
+    def set_depth_probe(self, depth_probe: Callable[[], Awaitable[int]], max_backend_depth: int) -> None:
+        self.depth_probe = depth_probe
+        self.max_backend_depth = max_backend_depth
+
+    def retry_after(self) -> int:
+        waves = (len(self.waiting) + 1) / max(self.max_running, 1)
+        return min(max(int(math.ceil(waves * self.average_duration)), 1), 300)
+
+    def enqueue(self, job, user_id: str, priority: str) -> Ticket:
+        """
+        Queues a job, synchronously so a burst of submissions is counted
+        against the limits right away.
+
+        Raises:
+            Saturated: If a new job of the user can't be queued right now.
+        """
+        user_id = str(user_id)
+        if len(self.waiting) >= self.max_queued:
+            raise Saturated(f"{self.route.upper()} QUEUE IS FULL", self.retry_after())
+
+        user_waiting = sum(1 for ticket in self.waiting if ticket.user_id == user_id)
+        if user_waiting >= self.max_queued_per_user:
+            raise Saturated(f"TOO MANY QUEUED {self.route.upper()} JOBS FOR USER", self.retry_after())
+
+        ticket = Ticket(job, user_id, PRIORITIES.get(priority, PRIORITIES['normal']), next(self._seq))
+        self.waiting.append(ticket)
+        return ticket
+
+    def _sort_key(self, ticket: Ticket):
+        return (ticket.lane,
+                self.running_by_user[ticket.user_id],
+                self.last_started.get(ticket.user_id, -1),
+                ticket.seq)
+
+    def position(self, job) -> Optional[int]:
+        """
+        Returns the 0-based position of a waiting job in the current start order.
+        """
+        for position, ticket in enumerate(sorted(self.waiting, key=self._sort_key)):
+            if ticket.job is job:
+                return position
+        return None
+
+    def _backend_full(self) -> bool:
+        return self.depth_probe is not None and self.max_backend_depth > 0 and self.backend_depth >= self.max_backend_depth
+
+    def _dispatch(self) -> None:
+        while self.waiting and self.running < self.max_running and not self._backend_full():
+            ticket = min(self.waiting, key=self._sort_key)
+            self.waiting.remove(ticket)
+            if ticket.granted.done():
+                # Cancelled while waiting, its job is unwinding
+                continue
+            self.running += 1
+            self.running_by_user[ticket.user_id] += 1
+            self.last_started[ticket.user_id] = next(self._dispatched)
+            ticket.granted.set_result(None)
+
+        if self.waiting and self._backend_full() and (self._prober is None or self._prober.done()):
+            self._prober = log.create_background_task(self._probe())
+
+    async def _probe(self) -> None:
+        # Polls the backend while jobs are held back by its queue depth
+        while self.waiting and self._backend_full():
+            await asyncio.sleep(self.probe_interval)
+            await self.refresh_backend_depth()
+        self._dispatch()
+
+    async def refresh_backend_depth(self) -> None:
+        if self.depth_probe is None:
+            return
+        try:
+            self.backend_depth = await self.depth_probe()
+        except Exception as e:
+            logger.warning("COULDN'T READ THE %s BACKEND QUEUE DEPTH: %s", self.route.upper(), e)
+
+    async def acquire(self, ticket: Ticket) -> None:
+        """
+        Waits until the job of a queued ticket may start.
+        """
+        await self.refresh_backend_depth()
+        self._dispatch()
+
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            self.abandon(ticket)
+            raise
+
+    def abandon(self, ticket: Ticket) -> None:
+        """
+        Drops a ticket whose job won't run, e.g. cancelled before it started,
+        giving back its slot if it was already granted one.
+        """
+        if ticket in self.waiting:
+            self.waiting.remove(ticket)
+            self._dispatch()
+        elif ticket.granted.done() and not ticket.granted.cancelled():
+            self.release(ticket, None)
+
+    def release(self, ticket: Ticket, duration: Optional[float]) -> None:
+        """
+        Gives back the slot of a granted ticket. Releasing it again is a no-op.
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+
+        user_id = ticket.user_id
+        self.running -= 1
+        self.running_by_user[user_id] -= 1
+        if self.running_by_user[user_id] <= 0:
+            del self.running_by_user[user_id]
+            if not any(waiting.user_id == user_id for waiting in self.waiting):
+                self.last_started.pop(user_id, None)
+        if duration is not None:
+            self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+        self._dispatch()
+
+class Scheduler:
+    def __init__(self, routes: Dict[str, RouteScheduler]) -> None:
+        self.routes = routes
+
+    def __getitem__(self, route: str) -> RouteScheduler:
+        return self.routes[route]
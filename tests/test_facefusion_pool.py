@@ -0,0 +1,177 @@
+"""
+Runs the FaceFusion worker pool against `facefusion_worker.py --stub`, which
+copies the target to the output instead of loading FaceFusion, so the pool's
+process handling can be tested on CPU.
+"""
+import asyncio
+import os
+import signal
+import sys
+
+import pytest
+
+import facefusion_pool
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'facefusion_worker.py')
+
+def stub_pool(delay=0.0, size=1, job_timeout=None, health_interval=30.0):
+    command = [sys.executable, WORKER_SCRIPT, '--stub', '--stub-delay', str(delay)]
+    return facefusion_pool.FaceFusionPool(size=size,
+                                          command=command,
+                                          start_timeout=30,
+                                          job_timeout=job_timeout,
+                                          health_interval=health_interval)
+
+def job_args(tmp_path, name='output.mp4'):
+    target = tmp_path / 'target.mp4'
+    if not target.exists():
+        target.write_bytes(b'video')
+    return ['--target', str(target), '--output', str(tmp_path / name)]
+
+def group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_runs_a_job_and_reports_progress(tmp_path):
+    async def main():
+        pool = stub_pool(delay=0.1)
+        progress = []
+
+        async def on_progress(frame, frames):
+            progress.append((frame, frames))
+
+        try:
+            await pool.run(job_args(tmp_path), on_progress)
+        finally:
+            await pool.stop()
+        return progress
+
+    progress = run(main())
+    assert (tmp_path / 'output.mp4').read_bytes() == b'video'
+    assert progress[-1] == (10, 10)
+
+def test_error_reply_keeps_the_worker(tmp_path):
+    async def main():
+        pool = stub_pool()
+        try:
+            await pool.start()
+            pid = pool.workers[0].process.pid
+            with pytest.raises(facefusion_pool.FaceFusionError):
+                await pool.run(['--target', str(tmp_path / 'missing.mp4'), '--output', str(tmp_path / 'out.mp4')])
+            assert pool.workers[0].alive
+            assert pool.workers[0].process.pid == pid
+        finally:
+            await pool.stop()
+
+    run(main())
+
+def test_restarts_a_crashed_worker(tmp_path):
+    async def main():
+        pool = stub_pool()
+        try:
+            await pool.start()
+            worker = pool.workers[0]
+            crashed_pid = worker.process.pid
+            os.kill(crashed_pid, signal.SIGKILL)
+            await worker.process.wait()
+
+            await pool.run(job_args(tmp_path))
+            assert worker.alive
+            assert worker.process.pid != crashed_pid
+        finally:
+            await pool.stop()
+
+    run(main())
+    assert (tmp_path / 'output.mp4').exists()
+
+def test_restarts_a_worker_after_a_timeout(tmp_path):
+    async def main():
+        pool = stub_pool(delay=5.0, job_timeout=0.3)
+        try:
+            await pool.start()
+            worker = pool.workers[0]
+            timed_out_pid = worker.process.pid
+
+            with pytest.raises(asyncio.TimeoutError):
+                await pool.run(job_args(tmp_path))
+
+            # The worker was mid-job, so it is replaced by a fresh one
+            assert worker.alive
+            assert worker.process.pid != timed_out_pid
+            assert not group_alive(timed_out_pid)
+        finally:
+            await pool.stop()
+
+    run(main())
+
+def test_cancel_kills_the_process_group(tmp_path):
+    async def main():
+        pool = stub_pool(delay=5.0)
+        try:
+            await pool.start()
+            worker = pool.workers[0]
+            pgid = worker.process.pid
+
+            task = asyncio.create_task(pool.run(job_args(tmp_path)))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            assert not group_alive(pgid)
+            assert not (tmp_path / 'output.mp4').exists()
+
+            # The worker is started again in the background, ahead of the next job
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if worker.alive:
+                    break
+            assert worker.alive
+            assert worker.process.pid != pgid
+            await pool.run(job_args(tmp_path, 'next.mp4'))
+        finally:
+            await pool.stop()
+
+    run(main())
+    assert (tmp_path / 'next.mp4').exists()
+
+def test_health_check_restarts_a_dead_worker():
+    async def main():
+        pool = stub_pool(health_interval=0.2)
+        try:
+            await pool.start()
+            worker = pool.workers[0]
+            dead_pid = worker.process.pid
+            os.kill(dead_pid, signal.SIGKILL)
+
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if worker.alive and worker.process.pid != dead_pid:
+                    break
+            assert worker.alive
+            assert worker.process.pid != dead_pid
+        finally:
+            await pool.stop()
+
+    run(main())
+
+def test_jobs_spread_over_the_workers(tmp_path):
+    async def main():
+        pool = stub_pool(delay=0.5, size=2)
+        try:
+            await pool.start()
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await asyncio.gather(pool.run(job_args(tmp_path, 'a.mp4')), pool.run(job_args(tmp_path, 'b.mp4')))
+            return loop.time() - started
+        finally:
+            await pool.stop()
+
+    # Two half-second jobs on two workers run side by side
+    assert run(main()) < 0.9
@@ -0,0 +1,130 @@
+"""
+Runs the input cache against an httpx MockTransport serving a few small
+files, checking shared downloads, eviction and what a failed or cancelled
+job gives back.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('httpx')
+# Blocking work goes through the job engine
+pytest.importorskip('fastapi')
+pytest.importorskip('pydantic')
+
+import httpx
+
+import downloads
+import input_cache
+
+FILES = {'/a': b'aaaa', '/b': b'bbbb', '/c': b'cccc', '/d': b'dddd'}
+
+class Server:
+    """
+    Serves FILES; a path in `held` waits for its event before answering.
+    """
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.held = {}
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.path)
+        if request.url.path in self.held:
+            await self.held[request.url.path].wait()
+        if request.url.path not in FILES:
+            return httpx.Response(404)
+        return httpx.Response(200, content=FILES[request.url.path])
+
+def make_cache(tmp_path, monkeypatch, max_bytes=1024):
+    server = Server()
+    downloader = downloads.Downloader(max_bytes=1024)
+    downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(server.handle), base_url='http://inputs')
+    monkeypatch.setattr(downloads, 'downloader', downloader)
+    return input_cache.InputCache(str(tmp_path / 'cache'), max_bytes), server
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_concurrent_jobs_share_one_download(tmp_path, monkeypatch):
+    cache, server = make_cache(tmp_path, monkeypatch)
+
+    async def main():
+        server.held['/a'] = asyncio.Event()
+        first = asyncio.create_task(cache.acquire('http://inputs/a'))
+        second = asyncio.create_task(cache.acquire('http://inputs/a'))
+        await asyncio.sleep(0.05)
+        server.held['/a'].set()
+        return await first, await second
+
+    first, second = run(main())
+    assert server.requests == ['/a']
+    assert first is second
+    assert first.refcount == 2
+    with open(first.path, 'rb') as f:
+        assert f.read() == b'aaaa'
+
+def test_eviction_skips_pinned_entries(tmp_path, monkeypatch):
+    cache, server = make_cache(tmp_path, monkeypatch, max_bytes=10)
+
+    async def main():
+        a = await cache.acquire('http://inputs/a')
+        b = await cache.acquire('http://inputs/b')
+        cache.release([b.digest])
+
+        # Over budget: b is older than c but a is still pinned, so b goes
+        c = await cache.acquire('http://inputs/c')
+        assert set(cache.entries) == {a.digest, c.digest}
+        assert 'http://inputs/b' not in cache.uris
+
+        # Once unpinned, a is the least recently used
+        cache.release([a.digest, c.digest])
+        d = await cache.acquire('http://inputs/d')
+        assert set(cache.entries) == {c.digest, d.digest}
+        return a, b
+
+    a, b = run(main())
+    assert not (tmp_path / 'cache' / a.digest).exists()
+    assert not (tmp_path / 'cache' / b.digest).exists()
+    assert cache.total_bytes == 8
+
+def test_failed_link_releases_the_other_inputs(tmp_path, monkeypatch):
+    cache, server = make_cache(tmp_path, monkeypatch)
+
+    async def main():
+        with pytest.raises(downloads.DownloadError):
+            await cache.link_all([('http://inputs/a', str(tmp_path / 'a')),
+                                  ('http://inputs/missing', str(tmp_path / 'missing'))])
+
+    run(main())
+    assert [entry.refcount for entry in cache.entries.values()] == [0]
+    assert not list((tmp_path / 'cache').glob('tmp-*'))
+
+def test_cancelled_link_releases_the_downloaded_inputs(tmp_path, monkeypatch):
+    cache, server = make_cache(tmp_path, monkeypatch)
+
+    async def main():
+        server.held['/b'] = asyncio.Event()
+        task = asyncio.create_task(cache.link_all([('http://inputs/a', str(tmp_path / 'a')),
+                                                   ('http://inputs/b', str(tmp_path / 'b'))]))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if (tmp_path / 'a').exists():
+                break
+        # a is pinned and linked, b is still downloading
+        assert [entry.refcount for entry in cache.entries.values()] == [1]
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The shared download of b still completes for whoever else wants it
+        server.held['/b'].set()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if 'http://inputs/b' in cache.uris:
+                break
+
+    run(main())
+    assert len(cache.entries) == 2
+    assert [entry.refcount for entry in cache.entries.values()] == [0, 0]
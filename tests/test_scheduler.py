@@ -0,0 +1,142 @@
+"""
+Runs jobs through a JobEngine with its own RouteScheduler, checking the start
+order, the limits and what a cancelled job gives back.
+"""
+import asyncio
+
+import pytest
+
+# The scheduler answers 429 through FastAPI and jobs are pydantic models
+pytest.importorskip('fastapi')
+pytest.importorskip('pydantic')
+
+import jobs
+import scheduler
+
+def make_engine(max_running=1, max_queued=100, max_queued_per_user=10):
+    route = scheduler.RouteScheduler('test', max_running, max_queued, max_queued_per_user)
+    engine = jobs.JobEngine(max_workers=2, scheduler=scheduler.Scheduler({'test': route}))
+    return engine, route
+
+async def record(job, name, started, gate=None):
+    started.append(name)
+    if gate is not None:
+        await gate.wait()
+    return name
+
+async def until(condition, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "TIMED OUT"
+        await asyncio.sleep(0.01)
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_users_take_turns():
+    async def main():
+        engine, route = make_engine()
+        started = []
+        submitted = [engine.submit('test', record, name, started, user_id=user)
+                     for name, user in (('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('b1', 'b'))]
+        await until(lambda: all(job.status == 'completed' for job in submitted))
+        return started, route
+
+    started, route = run(main())
+    # b's job goes ahead of a's queued ones once a has had a turn
+    assert started == ['a1', 'b1', 'a2', 'a3']
+    assert route.running == 0
+    assert not route.running_by_user
+
+def test_priority_lanes_start_first():
+    async def main():
+        engine, route = make_engine()
+        started = []
+        gate = asyncio.Event()
+        blocker = engine.submit('test', record, 'blocker', started, gate, user_id='a')
+        await until(lambda: blocker.status == 'running')
+
+        submitted = {priority: engine.submit('test', record, priority, started, user_id=priority, priority=priority)
+                     for priority in ('low', 'normal', 'high')}
+        positions = {priority: engine.get(job.job_id).queue_position for priority, job in submitted.items()}
+
+        gate.set()
+        await until(lambda: all(job.status == 'completed' for job in submitted.values()))
+        return started, positions
+
+    started, positions = run(main())
+    assert positions == {'high': 0, 'normal': 1, 'low': 2}
+    assert started == ['blocker', 'high', 'normal', 'low']
+
+def test_saturated_route_answers_429():
+    async def main():
+        engine, route = make_engine(max_queued=2, max_queued_per_user=1)
+        gate = asyncio.Event()
+        blocker = engine.submit('test', record, 'blocker', [], gate, user_id='a')
+        await until(lambda: blocker.status == 'running')
+
+        engine.submit('test', record, 'a', [], user_id='a')
+        with pytest.raises(scheduler.Saturated) as per_user:
+            engine.submit('test', record, 'a', [], user_id='a')
+
+        engine.submit('test', record, 'b', [], user_id='b')
+        with pytest.raises(scheduler.Saturated) as full:
+            engine.submit('test', record, 'c', [], user_id='c')
+
+        gate.set()
+        await until(lambda: route.running == 0 and not route.waiting)
+        return per_user.value, full.value
+
+    per_user, full = run(main())
+    assert per_user.status_code == 429
+    assert per_user.detail == "TOO MANY QUEUED TEST JOBS FOR USER"
+    assert full.status_code == 429
+    assert full.detail == "TEST QUEUE IS FULL"
+    # Two jobs waiting on one slot, at the default 60s a job
+    assert full.headers['Retry-After'] == '180'
+
+def test_cancel_while_queued_gives_back_the_slot():
+    async def main():
+        engine, route = make_engine()
+        started = []
+        gate = asyncio.Event()
+        blocker = engine.submit('test', record, 'blocker', started, gate, user_id='a')
+        await until(lambda: blocker.status == 'running')
+
+        queued = engine.submit('test', record, 'queued', started, user_id='b')
+        # Cancelled before its task even ran
+        unstarted = engine.submit('test', record, 'unstarted', started, user_id='c')
+        await engine.cancel(unstarted.job_id)
+        await asyncio.sleep(0.05)
+        await engine.cancel(queued.job_id)
+        assert not route.waiting
+
+        after = engine.submit('test', record, 'after', started, user_id='b')
+        gate.set()
+        await until(lambda: after.status == 'completed')
+        return started, route, queued, unstarted
+
+    started, route, queued, unstarted = run(main())
+    assert queued.status == 'cancelled'
+    assert unstarted.status == 'cancelled'
+    assert started == ['blocker', 'after']
+    assert route.running == 0
+    assert not route.running_by_user
+
+def test_cancel_while_running_releases_the_slot():
+    async def main():
+        engine, route = make_engine()
+        started = []
+        running = engine.submit('test', record, 'running', started, asyncio.Event(), user_id='a')
+        await until(lambda: running.status == 'running')
+
+        await engine.cancel(running.job_id)
+        after = engine.submit('test', record, 'after', started, user_id='a')
+        await until(lambda: after.status == 'completed')
+        return started, route, running
+
+    started, route, running = run(main())
+    assert running.status == 'cancelled'
+    assert started == ['running', 'after']
+    assert route.running == 0
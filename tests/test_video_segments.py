@@ -0,0 +1,76 @@
+"""
+Splits a tiny generated clip, runs the segments through the stub FaceFusion
+worker and joins them again. Skipped when ffmpeg isn't installed.
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import facefusion_pool
+import video_segments
+
+pytestmark = pytest.mark.skipif(shutil.which(video_segments.FFMPEG) is None or shutil.which(video_segments.FFPROBE) is None,
+                                reason="ffmpeg isn't installed")
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'facefusion_worker.py')
+
+def make_clip(path, seconds=4):
+    # One keyframe per second, so the clip can be cut into several segments
+    subprocess.run([video_segments.FFMPEG, '-v', 'error', '-y',
+                    '-f', 'lavfi', '-i', f"testsrc=duration={seconds}:size=64x64:rate=10",
+                    '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}",
+                    '-c:v', 'libx264', '-g', '10', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+                    str(path)], check=True)
+
+def probe_streams(path):
+    output = subprocess.run([video_segments.FFPROBE, '-v', 'error', '-show_entries', 'stream=codec_type',
+                             '-of', 'json', str(path)], check=True, capture_output=True, text=True).stdout
+    return sorted(stream['codec_type'] for stream in json.loads(output)['streams'])
+
+def test_split_and_concat_keep_the_audio(tmp_path):
+    clip = tmp_path / 'clip.mp4'
+    make_clip(clip)
+
+    async def main():
+        parts = await video_segments.split(str(clip), 2, str(tmp_path))
+        assert len(parts) >= 2
+        # The parts carry video only, the audio comes from the original
+        assert probe_streams(parts[0]) == ['video']
+
+        output = tmp_path / 'joined.mp4'
+        await video_segments.concat(parts, str(clip), str(output), str(tmp_path))
+        return output, await video_segments.probe_duration(str(output))
+
+    output, duration = asyncio.run(main())
+    assert probe_streams(output) == ['audio', 'video']
+    assert duration == pytest.approx(4, abs=0.5)
+
+def test_segmented_run_on_stub_workers(tmp_path, monkeypatch):
+    # facefusion imports the app's web and job modules
+    pytest.importorskip('fastapi')
+    pytest.importorskip('pydantic')
+    import facefusion
+
+    make_clip(tmp_path / 'target.mp4')
+    (tmp_path / 'source.png').write_bytes(b'face')
+
+    async def main():
+        pool = facefusion_pool.FaceFusionPool(size=2,
+                                              command=[sys.executable, WORKER_SCRIPT, '--stub', '--stub-delay', '0.1'],
+                                              start_timeout=30)
+        monkeypatch.setattr(facefusion, 'workers', pool)
+        try:
+            return await facefusion.run_facefusion_segmented(['source', 'target'], ['png', 'mp4'], str(tmp_path), 2)
+        finally:
+            await pool.stop()
+
+    output_path = asyncio.run(main())
+    assert probe_streams(output_path) == ['audio', 'video']
+    assert asyncio.run(video_segments.probe_duration(output_path)) == pytest.approx(4, abs=0.5)
+    # The scratch directory of the segments is gone
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('segments-')]
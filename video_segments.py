@@ -0,0 +1,72 @@
+import asyncio
+import glob
+import os
+
+import log
+
+from typing import List
+
+logger = log.get_logger(__name__)
+
+FFMPEG = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE = os.getenv('FFPROBE_BINARY', 'ffprobe')
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.webm', '.avi', '.m4v')
+
+class SegmentError(Exception):
+    pass
+
+def is_video(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+async def _run(*command: str) -> str:
+    process = await asyncio.create_subprocess_exec(*command,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise SegmentError(f"{os.path.basename(command[0]).upper()} FAILED: {stderr.decode(errors='replace')[-500:]}")
+    return stdout.decode()
+
+async def probe_duration(path: str) -> float:
+    output = await _run(FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path)
+    return float(output.strip())
+
+async def split(path: str, segments: int, work_dir: str) -> List[str]:
+    """
+    Splits the video stream of a file into about `segments` parts without
+    re-encoding. Stream copy can only cut at keyframes, so every part starts on
+    one and parts can be a little longer than an even share.
+
+    Returns:
+        List[str]: Paths of the parts, in order.
+    """
+    duration = await probe_duration(path)
+    extension = os.path.splitext(path)[1]
+    pattern = os.path.join(work_dir, f"segment-%03d{extension}")
+
+    await _run(FFMPEG, '-v', 'error', '-i', path,
+               '-map', '0:v:0', '-an', '-c', 'copy',
+               '-f', 'segment', '-segment_time', f"{duration / segments:.3f}", '-reset_timestamps', '1',
+               pattern)
+
+    parts = sorted(glob.glob(os.path.join(work_dir, f"segment-*{extension}")))
+    logger.info("SPLIT %.1fS OF VIDEO INTO %s SEGMENTS", duration, len(parts))
+    return parts
+
+async def concat(parts: List[str], audio_source: str, output_path: str, work_dir: str) -> None:
+    """
+    Joins processed parts with the concat demuxer, without re-encoding, and
+    takes the audio (if any) untouched from `audio_source`.
+    """
+    list_path = os.path.join(work_dir, 'segments.txt')
+    with open(list_path, 'w') as f:
+        for part in parts:
+            escaped = part.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    await _run(FFMPEG, '-v', 'error', '-y',
+               '-f', 'concat', '-safe', '0', '-i', list_path,
+               '-i', audio_source,
+               '-map', '0:v', '-map', '1:a?', '-c', 'copy',
+               output_path)
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+import time
+
+from collections import OrderedDict
+
+import httpx
+
+import jobs
+import log
+import metrics
+
+from typing import Dict, Optional, Set, Tuple
+
+logger = log.get_logger(__name__)
+
+class Delivery:
+    def __init__(self, url: str, key: str, payload: dict, attempts: int = 0) -> None:
+        self.url = url
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        self.next_attempt_at = 0.0
+
+    def to_dict(self) -> dict:
+        return {'url': self.url, 'key': self.key, 'payload': self.payload, 'attempts': self.attempts}
+
+class WebhookOutbox:
+    """
+    Background delivery of webhook notifications.
+
+    `send` only records the notification and returns. A sender task posts
+    pending notifications over one shared keep-alive client and retries
+    failures with exponential backoff. Notifications are keyed by URL and
+    message id, so a status update that hasn't gone out yet is replaced by a
+    newer one for the same message instead of both being sent. With a
+    persist path the pending notifications are written to disk and picked up
+    again after a restart.
+    """
+
+    def __init__(self,
+                 timeout: float = 10.0,
+                 max_attempts: int = 8,
+                 base_delay: float = 1.0,
+                 max_delay: float = 300.0,
+                 max_concurrency: int = 8,
+                 persist_path: Optional[str] = None) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.persist_path = persist_path
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(timeout))
+
+        self.pending: "OrderedDict[Tuple[str, str], Delivery]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], Delivery] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._sender: Optional[asyncio.Task] = None
+        self._dirty = False
+
+    def start(self) -> None:
+        if self._sender is not None:
+            return
+
+        self._wakeup = asyncio.Event()
+        if self.persist_path and os.path.exists(self.persist_path):
+            self._load()
+        self._sender = log.create_background_task(self._run())
+
+    async def stop(self) -> None:
+        if self._sender is not None:
+            self._sender.cancel()
+        await self._persist()
+        await self.client.aclose()
+
+    def send(self, url: str, key: str, payload: dict) -> None:
+        """
+        Queues a notification, replacing any undelivered one with the same key.
+
+        Args:
+            url (str): The URL of the webhook endpoint.
+            key (str): Identifies what the notification is about, e.g. the message id.
+            payload (dict): The JSON body.
+        """
+        self.start()
+
+        if (url, key) in self.pending:
+            logger.debug("WEBHOOK FOR %s SUPERSEDED BY A NEWER STATUS", key)
+        self.pending[(url, key)] = Delivery(url, key, payload)
+        self._dirty = True
+        self._wakeup.set()
+
+    def _load(self) -> None:
+        with open(self.persist_path) as f:
+            for item in json.load(f):
+                delivery = Delivery(**item)
+                self.pending[(delivery.url, delivery.key)] = delivery
+        logger.info("LOADED %s PENDING WEBHOOKS", len(self.pending))
+
+    def _write(self, deliveries: list) -> None:
+        tmp_path = self.persist_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(deliveries, f)
+        os.replace(tmp_path, self.persist_path)
+
+    async def _persist(self) -> None:
+        if not self.persist_path or not self._dirty:
+            return
+        self._dirty = False
+        # Deliveries in flight count as pending until they succeed
+        deliveries = dict(self._inflight)
+        deliveries.update(self.pending)
+        await jobs.engine.run_blocking(self._write, [d.to_dict() for d in deliveries.values()])
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            next_wakeup = None
+
+            for key, delivery in list(self.pending.items()):
+                if len(self._inflight) >= self.max_concurrency:
+                    break
+                if key in self._inflight:
+                    continue
+                if delivery.next_attempt_at > now:
+                    next_wakeup = min(next_wakeup or delivery.next_attempt_at, delivery.next_attempt_at)
+                    continue
+
+                del self.pending[key]
+                self._inflight[key] = delivery
+                task = asyncio.create_task(self._deliver(delivery))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            await self._persist()
+
+            self._wakeup.clear()
+            timeout = max(next_wakeup - time.monotonic(), 0) if next_wakeup else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, delivery: Delivery) -> None:
+        key = (delivery.url, delivery.key)
+        retry = False
+        start = time.perf_counter()
+        try:
+            delivery.attempts += 1
+            response = await self.client.post(delivery.url, json=delivery.payload)
+            metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - start, outcome=str(response.status_code))
+            if response.status_code < 300:
+                logger.info("WEBHOOK POST REQUEST WAS SUCCESSFUL: %s %s", delivery.key, delivery.payload.get('status'))
+            else:
+                logger.warning("WEBHOOK POST REQUEST FAILED: %s %s", delivery.key, response.status_code)
+                # Other client errors won't get better by retrying
+                retry = response.status_code >= 500 or response.status_code in (408, 429)
+        except Exception as e:
+            metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - start, outcome='error')
+            logger.warning("ERROR WHILE SENDING WEBHOOK POST REQUEST: %s %s", delivery.key, e)
+            retry = True
+        finally:
+            self._inflight.pop(key, None)
+
+        if retry and key not in self.pending:
+            if delivery.attempts < self.max_attempts:
+                delivery.next_attempt_at = time.monotonic() + self._backoff(delivery.attempts)
+                self.pending[key] = delivery
+            else:
+                logger.error("GIVING UP ON WEBHOOK FOR %s AFTER %s ATTEMPTS", delivery.key, delivery.attempts)
+
+        self._dirty = True
+        self._wakeup.set()
+
+
+outbox = WebhookOutbox(
+    timeout=float(os.getenv('WEBHOOK_TIMEOUT', '10')),
+    max_attempts=int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '8')),
+    base_delay=float(os.getenv('WEBHOOK_RETRY_DELAY', '1')),
+    max_delay=float(os.getenv('WEBHOOK_MAX_RETRY_DELAY', '300')),
+    max_concurrency=int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '8')),
+    persist_path=os.getenv('WEBHOOK_OUTBOX_PATH') or None)
@@ -0,0 +1,169 @@
+import json
+import os
+
+import log
+
+from typing import Any, Dict, List, Optional
+
+logger = log.get_logger(__name__)
+
+class TemplateError(Exception):
+    pass
+
+def parse_bool(value: Any) -> bool:
+    # bool("false") is True, so strings and numbers are parsed explicitly
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ('true', '1', 'yes', 'on'):
+        return True
+    if isinstance(value, str) and value.strip().lower() in ('false', '0', 'no', 'off'):
+        return False
+    raise ValueError(f"NOT A BOOLEAN: {value!r}")
+
+PARAMETER_TYPES = {'int': int, 'float': float, 'str': str, 'bool': parse_bool}
+
+class WorkflowTemplate:
+    """
+    A named, versioned ComfyUI workflow (API format) kept on the server.
+
+    `parameters` maps every parameter a request may set to the node input it
+    patches, e.g. {"seed": {"node": "3", "input": "seed", "type": "int"}}.
+    Node ids never change between renders, so ComfyUI can reuse the cached
+    outputs of nodes whose inputs didn't change.
+
+    `max_input_side`, if set, caps the resolution of the input images handed to
+    the workflow, see preprocessing.
+    """
+
+    def __init__(self,
+                 template_id: str,
+                 version: int,
+                 workflow: dict,
+                 parameters: dict,
+                 max_input_side: Optional[int] = None) -> None:
+        self.template_id = template_id
+        self.version = version
+        self.workflow = workflow
+        self.parameters = parameters
+        self.max_input_side = max_input_side
+        self.validate()
+
+    def validate(self) -> None:
+        for node_id, node in self.workflow.items():
+            if not isinstance(node, dict) or 'class_type' not in node or not isinstance(node.get('inputs'), dict):
+                raise TemplateError(f"NODE {node_id} OF {self.template_id} V{self.version} IS NOT A COMFYUI API NODE")
+
+        for name, parameter in self.parameters.items():
+            node = self.workflow.get(str(parameter.get('node')))
+            if node is None:
+                raise TemplateError(f"PARAMETER {name} OF {self.template_id} V{self.version} TARGETS A MISSING NODE")
+            if parameter.get('input') not in node['inputs']:
+                raise TemplateError(f"PARAMETER {name} OF {self.template_id} V{self.version} TARGETS A MISSING INPUT")
+            if parameter.get('type', 'str') not in PARAMETER_TYPES:
+                raise TemplateError(f"PARAMETER {name} OF {self.template_id} V{self.version} HAS AN UNKNOWN TYPE")
+
+    def render(self, params: Dict[str, Any]) -> dict:
+        """
+        Returns the workflow with the given parameters patched in.
+
+        Only the patched nodes are copied; the other nodes are shared with the
+        template and must not be modified.
+
+        Args:
+            params (Dict[str, Any]): Values of the template's parameters.
+
+        Returns:
+            dict: The ComfyUI workflow, ready to be queued.
+        """
+        unknown = set(params) - set(self.parameters)
+        if unknown:
+            raise TemplateError(f"UNKNOWN PARAMETERS FOR {self.template_id} V{self.version}: {sorted(unknown)}")
+
+        workflow = dict(self.workflow)
+        for name, value in params.items():
+            parameter = self.parameters[name]
+            expected_type = PARAMETER_TYPES[parameter.get('type', 'str')]
+            try:
+                value = expected_type(value)
+            except (TypeError, ValueError):
+                raise TemplateError(f"PARAMETER {name} MUST BE OF TYPE {parameter.get('type', 'str')}")
+
+            node_id = str(parameter['node'])
+            if workflow[node_id] is self.workflow[node_id]:
+                workflow[node_id] = dict(self.workflow[node_id])
+                workflow[node_id]['inputs'] = dict(self.workflow[node_id]['inputs'])
+            workflow[node_id]['inputs'][parameter['input']] = value
+
+        return workflow
+
+    def describe(self) -> dict:
+        return {'template_id': self.template_id,
+                'version': self.version,
+                'parameters': self.parameters,
+                'max_input_side': self.max_input_side}
+
+class TemplateRegistry:
+    """
+    Registry of the workflow templates found in a directory, loaded and
+    validated once at startup. Every *.json file holds one template:
+
+        {"id": "txt2img", "version": 1, "workflow": {...}, "parameters": {...}, "max_input_side": 1536}
+    """
+
+    def __init__(self, templates_dir: str) -> None:
+        self.templates_dir = templates_dir
+        self.templates: Dict[str, Dict[int, WorkflowTemplate]] = {}
+
+    def load(self) -> None:
+        if not os.path.isdir(self.templates_dir):
+            logger.warning("NO WORKFLOW TEMPLATE DIRECTORY AT %s", self.templates_dir)
+            return
+
+        for filename in sorted(os.listdir(self.templates_dir)):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.templates_dir, filename)) as f:
+                data = json.load(f)
+            max_input_side = data.get('max_input_side')
+            self.add(WorkflowTemplate(data['id'],
+                                      int(data['version']),
+                                      data['workflow'],
+                                      data.get('parameters', {}),
+                                      int(max_input_side) if max_input_side is not None else None))
+
+        logger.info("LOADED WORKFLOW TEMPLATES: %s", {t: sorted(v) for t, v in self.templates.items()})
+
+    def add(self, template: WorkflowTemplate) -> None:
+        self.templates.setdefault(template.template_id, {})[template.version] = template
+
+    def get(self, template_id: str, version: Optional[int] = None) -> WorkflowTemplate:
+        """
+        Returns a template, by default its latest version.
+        """
+        versions = self.templates.get(template_id)
+        if not versions:
+            raise TemplateError(f"UNKNOWN WORKFLOW TEMPLATE: {template_id}")
+        if version is None:
+            return versions[max(versions)]
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            raise TemplateError(f"INVALID VERSION {version} OF WORKFLOW TEMPLATE {template_id}")
+        if version not in versions:
+            raise TemplateError(f"UNKNOWN VERSION {version} OF WORKFLOW TEMPLATE {template_id}")
+        return versions[version]
+
+    def render(self, template_id: str, version: Optional[int], params: Dict[str, Any]) -> dict:
+        return self.get(template_id, version).render(params)
+
+    def describe(self) -> List[dict]:
+        return [template.describe()
+                for versions in self.templates.values()
+                for template in versions.values()]
+
+
+registry = TemplateRegistry(os.getenv('WORKFLOW_TEMPLATES_DIR',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflows')))
+registry.load()